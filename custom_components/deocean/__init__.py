@@ -9,31 +9,82 @@
 所以大多是猜测模拟的。不保证所有功能都可用。
 
 """
-import socket
+
+import asyncio
 import logging
+from functools import partial
+import voluptuous as vol
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import CONF_HOST, CONF_PORT
-from homeassistant.core import HomeAssistant
+from homeassistant.core import (
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+    callback,
+)
+from homeassistant.helpers import config_validation as cv
 from homeassistant.exceptions import ConfigEntryNotReady
 from homeassistant.helpers import device_registry as dr
-from .hub import DeoceanGateway, register_devices, register_scenes
-from .const import DOMAIN, CONF_DEVICES, CONF_SCENES, DEFAULT_PORT, VERSION
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
+from .hub import DeoceanGateway, TypeCode, register_devices, register_scenes
+from .const import (
+    DOMAIN,
+    CONF_DEVICES,
+    CONF_SCENES,
+    CONF_SEND_RATE,
+    CONF_MIN_GAP,
+    CONF_RECONCILE_RATE,
+    CONF_PROFILING,
+    CONF_SCENE_DIFF,
+    DEFAULT_PORT,
+    DEFAULT_SEND_RATE,
+    DEFAULT_MIN_GAP,
+    DEFAULT_RECONCILE_RATE,
+    DEFAULT_PROFILING,
+    DEFAULT_SCENE_DIFF,
+    EVENT_PANEL_PRESS,
+    SERVICE_PROFILE,
+    SIGNAL_DEVICES_ADDED,
+    STATE_MAX_AGE,
+    STORAGE_SAVE_DELAY,
+    STORAGE_VERSION,
+    VERSION,
+)
 
-PLATFORMS = ["light", "cover"]
+PLATFORMS = ["light", "cover", "sensor"]
 
 _LOGGER = logging.getLogger(__package__)
 
+PROFILE_SCHEMA = vol.Schema(
+    {
+        vol.Optional("enabled"): cv.boolean,
+        vol.Optional("sample_every", default=8): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=1000)
+        ),
+    }
+)
+
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     hub = DeoceanGateway(
-        entry.data[CONF_HOST], entry.data.get(CONF_PORT, DEFAULT_PORT), 10
+        entry.data[CONF_HOST],
+        entry.data.get(CONF_PORT, DEFAULT_PORT),
+        10,
+        send_rate=entry.data.get(CONF_SEND_RATE, DEFAULT_SEND_RATE),
+        min_gap=entry.data.get(CONF_MIN_GAP, DEFAULT_MIN_GAP) / 1000,
+        reconcile_rate=entry.data.get(CONF_RECONCILE_RATE, DEFAULT_RECONCILE_RATE),
+        reconcile_max_age=STATE_MAX_AGE,
     )
     try:
         _LOGGER.debug(
             f"尝试监听 IP={entry.data[CONF_HOST]}, PORT={entry.data.get(CONF_PORT, DEFAULT_PORT)}"
         )
-        hub.start_listen()
-    except socket.error as err:
+        await hub.async_start_listen()
+    except (OSError, asyncio.TimeoutError) as err:
         _LOGGER.error(f"德能森监听失败啦:{err}")
         raise ConfigEntryNotReady from err
 
@@ -60,25 +111,235 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][entry.entry_id] = hub
 
+    if entry.data.get(CONF_PROFILING, DEFAULT_PROFILING):
+        hub.set_profiling(True)
+    hub.scene_diff = entry.data.get(CONF_SCENE_DIFF, DEFAULT_SCENE_DIFF)
+    hub.scene_diff_max_age = STATE_MAX_AGE
+    _async_register_services(hass)
+
+    # 上次保存的设备状态, 实体加入时直接显示, 不用等网关回复
+    store = _state_store(hass, entry)
+    if snapshot := await store.async_load():
+        _LOGGER.debug(f"从快照恢复了 {hub.restore(snapshot)} 个设备的状态")
+    hub.state_listener = _async_snapshot_saver(hass, entry, hub, store)
+    # 卸载(包括重新加载)时立即写入, 新的配置条目加载时读到的是最新状态
+    entry.async_on_unload(lambda: store.async_save(hub.snapshot()))
+
+    # 状态未知或者过期的设备在后台同步, 收到回复之后再更新. 启动耗时与设备数量无关
+    entry.async_create_background_task(
+        hass,
+        hub.async_sync_all(max_age=STATE_MAX_AGE),
+        f"{DOMAIN}_sync_{entry.entry_id}",
+    )
+
     # 注册网关设备 - 提供网关状态监控和逻辑层次结构
+    # 同一个 IP 可能有多个网关(比如 proxy.py 在不同端口上), 所以设备标识用 IP:端口
+    _async_migrate_gateway_device(hass, entry, hub)
     device_registry = dr.async_get(hass)
-    device_registry.async_get_or_create(
+    gateway_device = device_registry.async_get_or_create(
         config_entry_id=entry.entry_id,
-        identifiers={(DOMAIN, f"gateway_{hub.ip_addr}")},
+        identifiers={(DOMAIN, f"gateway_{hub.unique_id}")},
         name=f"德能森网关 ({hub.ip_addr})",
         manufacturer="德能森",
         model="智能网关",
         sw_version=VERSION,
     )
+    # 迁移之前多个条目共用过的网关设备, 不再属于当前条目
+    for device in dr.async_entries_for_config_entry(device_registry, entry.entry_id):
+        if device.id != gateway_device.id and any(
+            domain == DOMAIN and id.startswith("gateway_")
+            for domain, id in device.identifiers
+        ):
+            device_registry.async_update_device(
+                device.id, remove_config_entry_id=entry.entry_id
+            )
 
+    # 所有面板按键都作为事件发出(配置了场景的会先执行场景), 可以在 hass 的自动化中使用
+    hub.panel_event_base = {"device_id": gateway_device.id, "gateway": hub.unique_id}
+    hub.panel_listener = partial(hass.bus.async_fire, EVENT_PANEL_PRESS)
+
+    await _async_migrate_unique_ids(hass, entry, hub)
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
 
+    # 选项中修改的配置直接应用到正在运行的网关, 不重新加载
+    entry.async_on_unload(
+        entry.add_update_listener(
+            partial(_async_update_listener, applied=dict(entry.data))
+        )
+    )
+
     return True
 
 
+async def _async_update_listener(
+    hass: HomeAssistant, entry: ConfigEntry, applied: dict
+):
+    """配置修改之后增量应用到正在运行的网关, 不断开连接, 也不用重新同步所有设备.
+
+    applied 为上一次应用的配置, 只处理有变化的部分. 只有网关地址变了才需要重新加载.
+    """
+    hub: DeoceanGateway = hass.data[DOMAIN][entry.entry_id]
+    data = entry.data
+    changed = {key for key in {*data, *applied} if data.get(key) != applied.get(key)}
+    applied.clear()
+    applied.update(data)
+    if changed & {CONF_HOST, CONF_PORT}:
+        await hass.config_entries.async_reload(entry.entry_id)
+        return
+
+    if changed & {CONF_SEND_RATE, CONF_MIN_GAP}:
+        hub.scheduler.configure(
+            data.get(CONF_SEND_RATE, DEFAULT_SEND_RATE),
+            data.get(CONF_MIN_GAP, DEFAULT_MIN_GAP) / 1000,
+        )
+    if CONF_RECONCILE_RATE in changed:
+        hub.set_reconcile_rate(data.get(CONF_RECONCILE_RATE, DEFAULT_RECONCILE_RATE))
+    if CONF_PROFILING in changed:
+        hub.set_profiling(data.get(CONF_PROFILING, DEFAULT_PROFILING))
+    if CONF_SCENE_DIFF in changed:
+        hub.scene_diff = data.get(CONF_SCENE_DIFF, DEFAULT_SCENE_DIFF)
+    if changed & {CONF_DEVICES, CONF_SCENES}:
+        _async_apply_devices(hass, entry, hub)
+
+
+@callback
+def _async_apply_devices(hass: HomeAssistant, entry: ConfigEntry, hub: DeoceanGateway):
+    """设备/场景配置的差异: 只增删有变化的设备和实体, 只重新编译有变化的场景"""
+    added, removed = hub.apply_devices(entry.data.get(CONF_DEVICES, ""))
+    # 设备变化之后, 之前因为没有设备而没有注册的场景可能生效了, 所以总是一起检查
+    scenes = hub.apply_scenes(entry.data.get(CONF_SCENES, ""))
+
+    # 删除实体注册表中的条目, 对应的实体会随之移除
+    registry = er.async_get(hass)
+    for dev in removed:
+        platform = "cover" if dev.type == TypeCode.COVER else "light"
+        if entity_id := registry.async_get_entity_id(platform, DOMAIN, dev.unique_id):
+            registry.async_remove(entity_id)
+    if added:
+        async_dispatcher_send(hass, SIGNAL_DEVICES_ADDED.format(entry.entry_id), added)
+        # 只有新增的(状态未知)和状态过期的设备会被同步
+        entry.async_create_background_task(
+            hass,
+            hub.async_sync_all(max_age=STATE_MAX_AGE),
+            f"{DOMAIN}_sync_{entry.entry_id}",
+        )
+    if (added or removed) and hub.state_listener is not None:
+        hub.state_listener()
+    _LOGGER.info(
+        f"配置已更新: 新增 {len(added)} 个设备, 移除 {len(removed)} 个设备, {scenes} 个场景有变化"
+    )
+
+
+@callback
+def _async_register_services(hass: HomeAssistant):
+    """所有网关共用的服务, 只注册一次"""
+    if hass.services.has_service(DOMAIN, SERVICE_PROFILE):
+        return
+
+    @callback
+    def _async_profile(call: ServiceCall) -> ServiceResponse:
+        """打开/关闭所有网关的耗时采样, 返回各网关的采样报告"""
+        hubs: list[DeoceanGateway] = list(hass.data.get(DOMAIN, {}).values())
+        if (enabled := call.data.get("enabled")) is not None:
+            for hub in hubs:
+                hub.set_profiling(enabled, call.data["sample_every"])
+        return {hub.unique_id: hub.profiling_report() for hub in hubs}
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_PROFILE,
+        _async_profile,
+        schema=PROFILE_SCHEMA,
+        supports_response=SupportsResponse.OPTIONAL,
+    )
+
+
+@callback
+def _async_migrate_gateway_device(
+    hass: HomeAssistant, entry: ConfigEntry, hub: DeoceanGateway
+):
+    """旧版本的网关设备标识只有 IP, 同一个 IP 不同端口的网关会合并成一个设备, 迁移成 IP:端口"""
+    device_registry = dr.async_get(hass)
+    legacy = device_registry.async_get_device(
+        identifiers={(DOMAIN, f"gateway_{hub.ip_addr}")}
+    )
+    identifier = (DOMAIN, f"gateway_{hub.unique_id}")
+    if (
+        legacy is not None
+        and entry.entry_id in legacy.config_entries
+        and device_registry.async_get_device(identifiers={identifier}) is None
+    ):
+        device_registry.async_update_device(legacy.id, new_identifiers={identifier})
+
+
+async def _async_migrate_unique_ids(
+    hass: HomeAssistant, entry: ConfigEntry, hub: DeoceanGateway
+):
+    """旧版本实体的 unique_id 只有8位设备地址, 支持多网关之后加上网关前缀, 避免地址冲突.
+
+    旧版本创建的配置条目没有 unique_id, 补上之后重复添加同一个网关时才能被拦截.
+    """
+    if entry.unique_id is None and not any(
+        other.unique_id == hub.unique_id
+        for other in hass.config_entries.async_entries(DOMAIN)
+    ):
+        hass.config_entries.async_update_entry(entry, unique_id=hub.unique_id)
+
+    @callback
+    def _migrate(entity_entry: er.RegistryEntry):
+        if len(entity_entry.unique_id) != 8:
+            return None
+        return {"new_unique_id": f"{hub.unique_id}-{entity_entry.unique_id}"}
+
+    await er.async_migrate_entries(hass, entry.entry_id, _migrate)
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     if unload_ok:
         hub: DeoceanGateway = hass.data[DOMAIN].pop(entry.entry_id)
         hub.stop_listen()
     return unload_ok
+
+
+async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """删除配置条目时一并删除状态快照"""
+    await _state_store(hass, entry).async_remove()
+
+
+@callback
+def _async_snapshot_saver(
+    hass: HomeAssistant, entry: ConfigEntry, hub: DeoceanGateway, store: Store
+):
+    """设备有回复之后, 最多 STORAGE_SAVE_DELAY 秒写一次快照.
+
+    不直接用 store.async_delay_save: 它每次调用都会重新计时, 设备消息比这个间隔更频繁时
+    (比如后台对账) 会一直推迟到退出才写入, 中途崩溃就丢了快照. 这里计时开始之后不再重置.
+    """
+    unsub = None
+
+    @callback
+    def _save(_now):
+        nonlocal unsub
+        unsub = None
+        # 延迟为 0, 仍然由 Store 负责 hass 退出前的最后一次写入
+        store.async_delay_save(hub.snapshot, 0)
+
+    @callback
+    def _schedule():
+        nonlocal unsub
+        if unsub is None:
+            unsub = async_call_later(hass, STORAGE_SAVE_DELAY, _save)
+
+    @callback
+    def _cancel():
+        if unsub is not None:
+            unsub()
+
+    entry.async_on_unload(_cancel)
+    return _schedule
+
+
+def _state_store(hass: HomeAssistant, entry: ConfigEntry) -> Store:
+    """每个网关一个设备状态快照"""
+    return Store(hass, STORAGE_VERSION, f"{DOMAIN}.{entry.entry_id}.state")
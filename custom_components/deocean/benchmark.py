@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+面板按键到设备动作的端到端延迟压测
+
+用 mock_deocean_server.py 模拟网关, 按固定速率注入面板按键帧, 测量完整的链路:
+    mock 发出按键帧 -> hub 解析 -> 查找场景 -> 发出设备指令 -> mock 收到最后一条指令
+每个场景大小(设备数) x 每个按键速率跑一轮, 输出 p50/p95/p99 的 JSON, 可以保存下来和其他版本对比.
+
+mock 和 hub 跑在同一个进程里(mock 在线程中), 绝对数值会受 GIL 影响, 只适合同一台机器上前后对比.
+默认发送限速放开到很大, 测的是代码本身的耗时, 而不是令牌桶的排队时间.
+
+用法(在 hub.py 所在目录执行):
+    python3 benchmark.py --output before.json
+    # 修改 hub.py 之后
+    python3 benchmark.py --baseline before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import platform
+import threading
+import time
+from typing import Dict, List, Union
+
+from hub import (
+    DeoceanGateway,
+    FuncCode,
+    Histogram,
+    register_devices,
+    register_scenes,
+)
+from const import VERSION
+from mock_deocean_server import MockDeoceanServer
+
+logger = logging.getLogger(__name__)
+
+# 压测用的面板地址, 每个场景大小占一个通道
+PANEL_ADDR = 0x0BE0C4A1
+# 压测设备的起始地址, 每4个设备里有1个窗帘
+DEVICE_BASE_ADDR = 0x0BE00000
+
+
+def _percentile(values: List[float], q: float) -> Union[float, None]:
+    """最近秩法的分位数, values 必须已经排好序"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(math.ceil(q * len(values)) - 1, 0))]
+
+
+def _ms(seconds: Union[float, None]) -> Union[float, None]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def build_config(max_devices: int, sizes: List[int]):
+    """生成设备配置, 以及每个场景大小对应的场景配置(前 n 个设备整组 toggle)"""
+    names = []
+    lines = []
+    for i in range(max_devices):
+        name = f"bench{i:03d}"
+        typ = "blind" if i % 4 == 3 else "light"
+        names.append(name)
+        lines.append(f"{name}, {typ}, {DEVICE_BASE_ADDR + i:08X}")
+    scenes = [
+        f"bench_{size}, {PANEL_ADDR:08X}, {channel}, {'|'.join(names[:size])}, toggle"
+        for channel, size in enumerate(sizes, 1)
+    ]
+    return "\n".join(lines), "\n".join(scenes)
+
+
+class PressRecorder:
+    """在 mock 的客户端线程中记录设备指令到达的时间, 按顺序对应到每一次按键"""
+
+    def __init__(self, frames_per_press: int, presses: int):
+        self.frames_per_press = frames_per_press
+        self.presses = presses
+        self.sent_at: List[float] = []
+        self.first_at: List[float] = []
+        self.done_at: List[float] = []
+        self.received = 0
+        self.done = threading.Event()
+
+    def on_frame(self, frame):
+        if frame.func_code not in (FuncCode.SWITCH, FuncCode.COVER_POSITION):
+            return
+        now = time.perf_counter()
+        self.received += 1
+        if self.received % self.frames_per_press == 1 or self.frames_per_press == 1:
+            self.first_at.append(now)
+        if self.received % self.frames_per_press == 0:
+            self.done_at.append(now)
+            if len(self.done_at) >= self.presses:
+                self.done.set()
+
+
+def _inject(
+    server: MockDeoceanServer, channel: int, rate: float, recorder: PressRecorder
+):
+    """开环注入: 按固定节奏发送, 不等上一次按键完成, 积压的延迟会体现在结果里"""
+    interval = 1.0 / rate
+    begin = time.perf_counter()
+    for i in range(recorder.presses):
+        delay = begin + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        recorder.sent_at.append(time.perf_counter())
+        server.press(PANEL_ADDR, channel)
+
+
+async def run_case(
+    server: MockDeoceanServer,
+    hub: DeoceanGateway,
+    size: int,
+    channel: int,
+    rate: float,
+    presses: int,
+    warmup: int,
+    timeout: float,
+) -> dict:
+    # 预热: 让场景执行路径和 socket 缓冲区都热起来, 不计入结果
+    if warmup:
+        recorder = PressRecorder(size, warmup)
+        server.frame_listener = recorder.on_frame
+        await asyncio.to_thread(_inject, server, channel, rate, recorder)
+        await asyncio.to_thread(recorder.done.wait, timeout)
+
+    hub.press_latency = Histogram(hub.press_latency.bounds)
+    recorder = PressRecorder(size, presses)
+    server.frame_listener = recorder.on_frame
+    began = time.perf_counter()
+    await asyncio.to_thread(_inject, server, channel, rate, recorder)
+    await asyncio.to_thread(recorder.done.wait, timeout)
+    elapsed = time.perf_counter() - began
+    server.frame_listener = None
+
+    completed = min(len(recorder.done_at), len(recorder.sent_at))
+    latency = sorted(
+        done - sent for sent, done in zip(recorder.sent_at, recorder.done_at)
+    )
+    first = sorted(
+        first - sent for sent, first in zip(recorder.sent_at, recorder.first_at)
+    )
+    result = {
+        "devices": size,
+        "rate": rate,
+        "presses": presses,
+        "completed": completed,
+        "frames_received": recorder.received,
+        "achieved_rate": round(completed / elapsed, 1) if elapsed else None,
+    }
+    for q in (0.5, 0.95, 0.99):
+        result[f"p{int(q * 100)}_ms"] = _ms(_percentile(latency, q))
+    result["max_ms"] = _ms(latency[-1] if latency else None)
+    result["first_frame_p50_ms"] = _ms(_percentile(first, 0.5))
+    result["first_frame_p99_ms"] = _ms(_percentile(first, 0.99))
+    # hub 内部从收到按键到场景指令入队的耗时
+    result["hub_press_p99_ms"] = hub.metrics()["press_latency_p99"]
+    if completed < presses:
+        logger.warning(
+            f"{size} 个设备 @ {rate}/s: 只完成了 {completed}/{presses} 次按键"
+        )
+    return result
+
+
+async def main(args) -> dict:
+    sizes = sorted(set(args.sizes))
+    devices_txt, scenes_txt = build_config(max(sizes), sizes)
+
+    server = MockDeoceanServer("127.0.0.1", 0, devices_txt)
+    threading.Thread(target=server.start, daemon=True).start()
+    if not server.started.wait(5):
+        raise RuntimeError("mock 服务器启动失败")
+
+    hub = DeoceanGateway(
+        "127.0.0.1", server.port, 10, send_rate=args.send_rate, min_gap=0
+    )
+    register_devices(hub, devices_txt)
+    register_scenes(hub, scenes_txt)
+    # 和 hass 中一样每次按键都会通知 panel_listener, hub 内部的按键耗时也只在这时记录
+    hub.panel_listener = lambda event: None
+    await hub.async_start_listen()
+    # 等 mock 那边登记好客户端, 否则最开始的按键没人收
+    while not server.clients:
+        await asyncio.sleep(0.01)
+
+    results = []
+    try:
+        for channel, size in enumerate(sizes, 1):
+            for rate in args.rates:
+                result = await run_case(
+                    server,
+                    hub,
+                    size,
+                    channel,
+                    rate,
+                    args.presses,
+                    args.warmup,
+                    args.timeout,
+                )
+                logger.info(
+                    f"{size:>4} 个设备 @ {rate:>6}/s: p50={result['p50_ms']}ms "
+                    f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms"
+                )
+                results.append(result)
+    finally:
+        hub.stop_listen()
+        server.stop()
+
+    return {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "sizes": sizes,
+            "rates": args.rates,
+            "presses": args.presses,
+            "warmup": args.warmup,
+            "send_rate": args.send_rate,
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict):
+    """和基准结果对比, 相同(设备数, 速率)的用例加上基准的 p99 和变化比例"""
+    previous: Dict[tuple, dict] = {
+        (item["devices"], item["rate"]): item for item in baseline["results"]
+    }
+    for item in report["results"]:
+        old = previous.get((item["devices"], item["rate"]))
+        if old is None or not old.get("p99_ms") or item["p99_ms"] is None:
+            continue
+        item["baseline_p99_ms"] = old["p99_ms"]
+        item["p99_change"] = round(item["p99_ms"] / old["p99_ms"] - 1, 3)
+    report["baseline"] = {
+        "version": baseline.get("version"),
+        "timestamp": baseline.get("timestamp"),
+    }
+
+
+def _numbers(value: str, cast=int) -> list:
+    return [cast(item) for item in value.split(",") if item.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="德能森面板按键端到端延迟压测")
+    parser.add_argument(
+        "--sizes",
+        type=_numbers,
+        default=[1, 10, 50, 100, 200],
+        help="场景设备数, 逗号分隔",
+    )
+    parser.add_argument(
+        "--rates",
+        type=lambda value: _numbers(value, float),
+        default=[1.0, 10.0, 100.0, 300.0],
+        help="每秒按键次数, 逗号分隔",
+    )
+    parser.add_argument("--presses", type=int, default=200, help="每轮按键次数")
+    parser.add_argument("--warmup", type=int, default=20, help="每轮预热按键次数")
+    parser.add_argument(
+        "--send-rate",
+        type=float,
+        default=1e6,
+        help="hub 每秒最多发送帧数, 默认相当于不限速",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30.0, help="每轮等待指令全部到达的最长秒数"
+    )
+    parser.add_argument("--output", help="结果写入文件, 默认输出到标准输出")
+    parser.add_argument("--baseline", help="之前保存的结果, 输出中加上 p99 的变化")
+    args = parser.parse_args()
+
+    # mock_deocean_server 导入时已经配置了 INFO 级别的日志, 压测时只看进度和警告
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    report = asyncio.run(main(args))
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
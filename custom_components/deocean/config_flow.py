@@ -17,10 +17,20 @@ from .const import (
     DOMAIN,
     CONF_DEVICES,
     CONF_SCENES,
+    CONF_SEND_RATE,
+    CONF_MIN_GAP,
+    CONF_RECONCILE_RATE,
+    CONF_PROFILING,
+    CONF_SCENE_DIFF,
     DEFAULT_DEVICES,
     DEFAULT_SCENES,
     DEFAULT_HOST,
     DEFAULT_PORT,
+    DEFAULT_SEND_RATE,
+    DEFAULT_MIN_GAP,
+    DEFAULT_RECONCILE_RATE,
+    DEFAULT_PROFILING,
+    DEFAULT_SCENE_DIFF,
 )
 from .hub import DeoceanGateway
 
@@ -31,14 +41,17 @@ class DeoceanConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     async def async_step_user(self, user_input=None):
         errors = {}
 
-        if self._async_current_entries():
-            return self.async_abort(reason="single_instance_allowed")
-
         if user_input is not None:
+            # 每个网关一个配置条目, 同一个网关不能重复添加
+            await self.async_set_unique_id(
+                f"{user_input[CONF_HOST]}:{user_input[CONF_PORT]}"
+            )
+            self._abort_if_unique_id_configured()
+
             # 验证网关连接
             hub = DeoceanGateway(user_input[CONF_HOST], user_input[CONF_PORT], 5)
             try:
-                hub.open_socket()
+                await hub.async_connect()
                 hub.stop_listen()
 
                 # 如果连接成功，进入设备配置步骤
@@ -91,7 +104,8 @@ class DeoceanConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
             # 创建配置条目
             return self.async_create_entry(
-                title="德能森智能家居", data=self._user_input
+                title=f"德能森智能家居 ({self._user_input[CONF_HOST]})",
+                data=self._user_input,
             )
 
         return self.async_show_form(
@@ -120,6 +134,7 @@ class DeoceanConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
 
 class DeoceanOptionsFlow(config_entries.OptionsFlow):
+    """修改之后的配置由 __init__ 中的更新监听增量应用到正在运行的网关, 不需要重新加载"""
 
     async def async_step_init(self, user_input=None):
         return await self.async_step_menu()
@@ -127,7 +142,13 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
     async def async_step_menu(self, user_input=None):
         return self.async_show_menu(
             step_id="menu",
-            menu_options=["devices", "scenes", "add_device", "add_scene"],
+            menu_options=[
+                "devices",
+                "scenes",
+                "add_device",
+                "add_scene",
+                "settings",
+            ],
         )
 
     async def async_step_devices(self, user_input=None):
@@ -138,7 +159,6 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
             self.hass.config_entries.async_update_entry(
                 self.config_entry, data=new_data
             )
-            await self.hass.config_entries.async_reload(self.config_entry.entry_id)
             return self.async_create_entry(title="", data={})
 
         current_devices = self.config_entry.data.get(CONF_DEVICES, DEFAULT_DEVICES)
@@ -167,7 +187,6 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
             self.hass.config_entries.async_update_entry(
                 self.config_entry, data=new_data
             )
-            await self.hass.config_entries.async_reload(self.config_entry.entry_id)
             return self.async_create_entry(title="", data={})
 
         current_scenes = self.config_entry.data.get(CONF_SCENES, DEFAULT_SCENES)
@@ -204,7 +223,6 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
             self.hass.config_entries.async_update_entry(
                 self.config_entry, data=new_data
             )
-            await self.hass.config_entries.async_reload(self.config_entry.entry_id)
             return self.async_create_entry(title="", data={})
 
         return self.async_show_form(
@@ -236,7 +254,6 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
             self.hass.config_entries.async_update_entry(
                 self.config_entry, data=new_data
             )
-            await self.hass.config_entries.async_reload(self.config_entry.entry_id)
             return self.async_create_entry(title="", data={})
 
         return self.async_show_form(
@@ -255,3 +272,41 @@ class DeoceanOptionsFlow(config_entries.OptionsFlow):
                 }
             ),
         )
+
+    async def async_step_settings(self, user_input=None):
+        if user_input is not None:
+            # 更新网关高级设置
+            new_data = dict(self.config_entry.data)
+            new_data.update(user_input)
+            self.hass.config_entries.async_update_entry(
+                self.config_entry, data=new_data
+            )
+            return self.async_create_entry(title="", data={})
+
+        data = self.config_entry.data
+        return self.async_show_form(
+            step_id="settings",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(
+                        CONF_SEND_RATE,
+                        default=data.get(CONF_SEND_RATE, DEFAULT_SEND_RATE),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=1, max=1000)),
+                    vol.Required(
+                        CONF_MIN_GAP, default=data.get(CONF_MIN_GAP, DEFAULT_MIN_GAP)
+                    ): vol.All(vol.Coerce(int), vol.Range(min=0, max=1000)),
+                    vol.Required(
+                        CONF_RECONCILE_RATE,
+                        default=data.get(CONF_RECONCILE_RATE, DEFAULT_RECONCILE_RATE),
+                    ): vol.All(vol.Coerce(int), vol.Range(min=0, max=600)),
+                    vol.Required(
+                        CONF_PROFILING,
+                        default=data.get(CONF_PROFILING, DEFAULT_PROFILING),
+                    ): bool,
+                    vol.Required(
+                        CONF_SCENE_DIFF,
+                        default=data.get(CONF_SCENE_DIFF, DEFAULT_SCENE_DIFF),
+                    ): bool,
+                }
+            ),
+        )
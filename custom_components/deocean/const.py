@@ -5,6 +5,15 @@ DOMAIN: str = "deocean"
 # 配置常量
 CONF_DEVICES = "devices"
 CONF_SCENES = "scenes"
+# 发送限速: 每秒最多发送的帧数, 以及俩次写入之间的最小间隔(毫秒)
+CONF_SEND_RATE = "send_rate"
+CONF_MIN_GAP = "min_gap"
+# 后台对账: 每分钟最多发送多少个状态同步帧, 0 表示关闭
+CONF_RECONCILE_RATE = "reconcile_rate"
+# 收包流水线耗时采样
+CONF_PROFILING = "profiling"
+# 场景只给状态需要改变的设备发指令
+CONF_SCENE_DIFF = "scene_diff"
 
 # 版本信息
 VERSION = "2.2.0"
@@ -12,6 +21,25 @@ VERSION = "2.2.0"
 # 默认网关配置
 DEFAULT_HOST = "192.168.5.201"
 DEFAULT_PORT = 50016
+DEFAULT_SEND_RATE = 20
+DEFAULT_MIN_GAP = 0
+DEFAULT_RECONCILE_RATE = 0
+DEFAULT_PROFILING = False
+DEFAULT_SCENE_DIFF = False
+
+# 服务
+SERVICE_PROFILE = "profile"
+
+# 面板按键事件, 事件数据包括 device_id(网关设备), button(地址:channel), address, channel, scene
+EVENT_PANEL_PRESS = f"{DOMAIN}_panel_press"
+
+# 配置修改之后新增的设备, 由各平台添加实体. 参数为配置条目 ID
+SIGNAL_DEVICES_ADDED = f"{DOMAIN}_devices_added_{{}}"
+
+# 设备状态快照: 存储版本, 状态变化后延迟多少秒写入, 以及快照中的状态多久之后需要重新同步(秒)
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 10
+STATE_MAX_AGE = 600
 
 # 德能森内置灯具和窗帘
 # grep -E 'blind|light' dev_rep_list.txt  | grep -v '^light' | cut -d, -f1-3
@@ -6,9 +6,10 @@ from homeassistant.components.cover import (
     CoverEntityFeature,
 )
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
-from .const import DOMAIN, VERSION
+from .const import DOMAIN, SIGNAL_DEVICES_ADDED, VERSION
 from .hub import DeoceanDevice, DeoceanGateway, TypeCode
 
 
@@ -18,6 +19,19 @@ async def async_setup_entry(
     hub: DeoceanGateway = hass.data[DOMAIN][entry.entry_id]
     covers = hub.list_devices(TypeCode.COVER)
     async_add_entities([DeoceanCover(cover) for cover in covers])
+
+    @callback
+    def _async_add_covers(devices: list[DeoceanDevice]):
+        """配置修改之后新增的窗帘"""
+        async_add_entities(
+            [DeoceanCover(dev) for dev in devices if dev.type == TypeCode.COVER]
+        )
+
+    entry.async_on_unload(
+        async_dispatcher_connect(
+            hass, SIGNAL_DEVICES_ADDED.format(entry.entry_id), _async_add_covers
+        )
+    )
     return True
 
 
@@ -36,13 +50,8 @@ class DeoceanCover(CoverEntity):
         self.dev.register_update_callback(self._on_device_update)
 
     def _on_device_update(self, device):
-        """设备状态更新回调"""
-        # 当设备状态更新时，清除目标位置，避免一直显示opening/closing
-        if self.target_pos is not None:
-            current_pos = self.current_cover_position
-            if current_pos is not None and abs(current_pos - self.target_pos) <= 5:
-                self.target_pos = None
-        self.schedule_update_ha_state()
+        """设备状态更新回调, 网关在事件循环中合并之后回调, 每轮最多写一次状态"""
+        self.async_write_ha_state()
 
     @property
     def name(self):
@@ -56,7 +65,7 @@ class DeoceanCover(CoverEntity):
     def device_info(self):
         """返回设备信息 - 所有窗帘都属于同一个网关设备"""
         return {
-            "identifiers": {(DOMAIN, f"gateway_{self.dev.gw.ip_addr}")},
+            "identifiers": {(DOMAIN, f"gateway_{self.dev.gw.unique_id}")},
             "name": f"德能森网关 ({self.dev.gw.ip_addr})",
             "manufacturer": "德能森",
             "model": "智能网关",
@@ -79,9 +88,9 @@ class DeoceanCover(CoverEntity):
     @property
     def current_cover_position(self):
         """返回当前位置,如果设置开关,并不会直接返回position"""
-        # 如果有具体位置信息，优先使用位置信息
-        if self.dev.position is not None:
-            return self.dev.position
+        # 如果有具体位置信息，优先使用位置信息. 移动过程中是按学到的速度插值的位置
+        if (position := self.dev.current_position) is not None:
+            return position
         # 否则根据开关状态推断位置
         if self.dev.is_on:
             return 100
@@ -91,16 +100,23 @@ class DeoceanCover(CoverEntity):
 
     @property
     def is_closed(self):
-        return self.current_cover_position == 0
+        position = self.current_cover_position
+        if position is None:
+            return None
+        return position == 0
 
     @property
     def is_opening(self):
+        if self.dev.motion.moving:
+            return self.dev.motion.direction > 0
         if self.target_pos is None or self.current_cover_position is None:
             return None
         return self.target_pos > self.current_cover_position
 
     @property
     def is_closing(self):
+        if self.dev.motion.moving:
+            return self.dev.motion.direction < 0
         if self.target_pos is None or self.current_cover_position is None:
             return None
         return self.target_pos < self.current_cover_position
@@ -119,4 +135,17 @@ class DeoceanCover(CoverEntity):
         """异步设置窗帘位置"""
         target_pos = kwargs.get("position")
         self.target_pos = target_pos
-        await self.hass.async_add_executor_job(self.dev.set_position, target_pos)
+        ack = await self.dev.async_control(int(target_pos), ack=True)
+        if ack is None:
+            self.target_pos = None
+            return
+        # 网关回复(或者超时)之后不再显示 opening/closing, 不用再猜位置是否到达
+        ack.add_done_callback(lambda fut: self._on_ack(fut, target_pos))
+
+    def _on_ack(self, fut, target_pos):
+        if not fut.cancelled():
+            fut.exception()  # 超时不需要额外处理, 这里只是取出异常避免日志警告
+        if self.target_pos == target_pos:
+            self.target_pos = None
+            if self.hass is not None:
+                self.async_write_ha_state()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""面板按键作为网关设备的设备触发器.
+
+每个按键(面板地址:channel)是一个触发器, 配置了场景或者启动之后按过的按键都会列出来.
+"""
+
+import voluptuous as vol
+
+from homeassistant.components.device_automation import DEVICE_TRIGGER_BASE_SCHEMA
+from homeassistant.components.homeassistant.triggers import event as event_trigger
+from homeassistant.const import (
+    CONF_DEVICE_ID,
+    CONF_DOMAIN,
+    CONF_PLATFORM,
+    CONF_TYPE,
+)
+from homeassistant.core import CALLBACK_TYPE, HomeAssistant
+from homeassistant.helpers import device_registry as dr
+from homeassistant.helpers.trigger import TriggerActionType, TriggerInfo
+from homeassistant.helpers.typing import ConfigType
+
+from .const import DOMAIN, EVENT_PANEL_PRESS
+from .hub import DeoceanGateway
+
+CONF_SUBTYPE = "subtype"
+TRIGGER_TYPE_PANEL_PRESS = "panel_press"
+
+TRIGGER_SCHEMA = DEVICE_TRIGGER_BASE_SCHEMA.extend(
+    {
+        vol.Required(CONF_TYPE): vol.In([TRIGGER_TYPE_PANEL_PRESS]),
+        vol.Required(CONF_SUBTYPE): str,
+    }
+)
+
+
+def _hub_for_device(hass: HomeAssistant, device_id: str):
+    device = dr.async_get(hass).async_get(device_id)
+    if device is None:
+        return None
+    for entry_id in device.config_entries:
+        hub: DeoceanGateway = hass.data.get(DOMAIN, {}).get(entry_id)
+        if hub is not None:
+            return hub
+    return None
+
+
+async def async_get_triggers(hass: HomeAssistant, device_id: str) -> list[dict]:
+    hub = _hub_for_device(hass, device_id)
+    if hub is None:
+        return []
+    return [
+        {
+            CONF_PLATFORM: "device",
+            CONF_DOMAIN: DOMAIN,
+            CONF_DEVICE_ID: device_id,
+            CONF_TYPE: TRIGGER_TYPE_PANEL_PRESS,
+            CONF_SUBTYPE: button,
+        }
+        for button in hub.panel_buttons()
+    ]
+
+
+async def async_attach_trigger(
+    hass: HomeAssistant,
+    config: ConfigType,
+    action: TriggerActionType,
+    trigger_info: TriggerInfo,
+) -> CALLBACK_TYPE:
+    """监听网关发出的面板按键事件"""
+    event_config = event_trigger.TRIGGER_SCHEMA(
+        {
+            event_trigger.CONF_PLATFORM: "event",
+            event_trigger.CONF_EVENT_TYPE: EVENT_PANEL_PRESS,
+            event_trigger.CONF_EVENT_DATA: {
+                CONF_DEVICE_ID: config[CONF_DEVICE_ID],
+                "button": config[CONF_SUBTYPE],
+            },
+        }
+    )
+    return await event_trigger.async_attach_trigger(
+        hass, event_config, action, trigger_info, platform_type="device"
+    )
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""德能森网关的诊断信息, 在 hass 的集成页面下载.
+
+包含连接/发送/同步的统计, 所有设备的当前状态, 以及飞行记录器中最近收发的原始数据.
+"""
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+from .hub import DeoceanGateway
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict:
+    hub: DeoceanGateway = hass.data[DOMAIN][entry.entry_id]
+    return {
+        "gateway": hub.unique_id,
+        "metrics": hub.metrics(),
+        "connection": hub.connection_stats(),
+        "scheduler": hub.scheduler.stats(),
+        "acks": hub.acks.stats(),
+        "sync": hub.sync_stats(),
+        "publish": hub.publish_stats(),
+        "profiling": hub.profiling_report(),
+        "panel": {
+            "presses": hub.panel_presses,
+            "latency": hub.press_latency.stats(),
+            "buttons": hub.panel_buttons(),
+        },
+        "devices": [
+            {
+                "name": dev.name,
+                "type": dev.type.name,
+                "addr": f"{addr:08X}",
+                "switch_status": dev.switch_status,
+                "position": dev.position,
+                "last_seen": dev.last_seen,
+            }
+            for addr, dev in hub.devices.items()
+        ],
+        "scenes": [
+            {"id": scene.id, "name": scene.name} for scene in hub.scenes.values()
+        ],
+        "frames": hub.recorder.dump(),
+    }
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-from typing import Callable, Dict, List, Union, Iterable
+from typing import Callable, Deque, Dict, Hashable, List, Tuple, Union, Iterable
+import asyncio
 import attr
-import copy
 import enum
+import random
 import time
 import socket
 import struct
@@ -17,8 +18,10 @@ from dataclasses import dataclass
 _LOGGER = logging.getLogger(__name__)
 
 from sys import platform
-from functools import partial
-from threading import Thread
+from array import array
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
 
 # 德能森的设备地址是8位的16进制
 Addr = Union[str, int, List[Union[str, int]]]
@@ -68,28 +71,756 @@ def batch_action(iter: Iterable, *args, **kwargs):
             callback(*args, **kwargs)
 
 
+# 发送优先级: 用户操作(开关灯/窗帘/场景)优先, 批量的状态同步靠后
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# 指令类别, 同一设备同一类别的指令在队列中最多只保留最新的一条
+# 开关/窗帘位置都是设置设备的目标状态, 属于同一类别
+CMD_TARGET = "target"
+CMD_SYNC = "sync"
+
+
+# 指令 -> 网关回复的功能码. 0B -> 0C, 1B -> 1C, 查询状态的回复二者皆有可能
+ACK_FUNC_CODES = {
+    0x0B: (0x0C,),
+    0x1B: (0x1C,),
+    0x0D: (0x0C, 0x1C),
+}
+
+
+class PendingAck:
+    """等待网关回复的指令, 同一帧被替换(合并)时, 多个 future 共用一个等待"""
+
+    __slots__ = ("addr", "expected", "futures", "sent_at", "timer")
+
+    def __init__(self, addr: int, expected: Tuple[int, ...]):
+        self.addr = addr
+        self.expected = expected
+        self.futures: List[asyncio.Future] = []
+        self.sent_at: Union[float, None] = None
+        self.timer: Union[asyncio.TimerHandle, None] = None
+
+    def set_result(self, rtt: float):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(rtt)
+
+    def set_exception(self, exc: BaseException):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        for future in self.futures:
+            future.cancel()
+
+
+class Histogram:
+    """固定分桶的直方图, 记录只需要一次二分查找和几次加法, 可以一直开着.
+
+    分位数按桶的上界估算, 落在最后一个桶之外的按最大值算.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    # 默认的分桶(秒), 适合局域网内的往返时间
+    DEFAULT_BOUNDS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, bounds: Tuple[float, ...] = DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> Union[float, None]:
+        """q 为 0~1, 没有数据时返回 None"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([*map(str, self.bounds), "inf"], self.counts)),
+        }
+
+
+class StageProfiler:
+    """收包流水线各个阶段的耗时采样.
+
+    阶段包括:
+        read      一次 socket 读取的全部处理时间(包括下面所有阶段, 实体回调除外)
+        decode    解帧
+        dispatch  路由到设备/场景(包括场景执行, 不包括设备状态更新)
+        update    DeoceanDevice.update
+        callback  单个实体回调(状态写入 hass), 同时按回调名称记录最慢的几个
+    读取和状态发布各自计数, 每 sample_every 次才计时一次, 可以在高负载下一直开着.
+    (共用一个计数的话, 每次读取之后正好一次发布, 俩者会锁在固定的相位上, 其中一个几乎永远采不到)
+    """
+
+    STAGES = ("read", "decode", "dispatch", "update", "callback")
+    # 采样点
+    SITE_READ = 0
+    SITE_PUBLISH = 1
+    # 分桶(秒), 从 10 微秒到 100 毫秒
+    BOUNDS = (1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 5e-2, 0.1)
+
+    def __init__(self, sample_every: int = 8, slowest: int = 10):
+        self.sample_every = max(1, sample_every)
+        self.slowest = slowest
+        self.stages = {stage: Histogram(self.BOUNDS) for stage in self.STAGES}
+        # 回调名称 -> 最长耗时(秒)
+        self.callbacks: Dict[str, float] = {}
+        self._ticks = [0, 0]  # 每个采样点一个计数
+        # 当前采样中 update 阶段累计的耗时, 用于从 dispatch 中扣除
+        self.update_spent = 0.0
+
+    def sample(self, site: int) -> bool:
+        """本次是否需要计时, site 为 SITE_READ 或 SITE_PUBLISH"""
+        ticks = self._ticks[site] + 1
+        if ticks < self.sample_every:
+            self._ticks[site] = ticks
+            return False
+        self._ticks[site] = 0
+        return True
+
+    def observe(self, stage: str, seconds: float):
+        self.stages[stage].observe(seconds)
+
+    def observe_callback(self, name: str, seconds: float):
+        self.stages["callback"].observe(seconds)
+        if seconds > self.callbacks.get(name, 0.0):
+            self.callbacks[name] = seconds
+
+    def report(self) -> dict:
+        """各阶段的 p50/p99/最大耗时(微秒), 以及最慢的回调(毫秒)"""
+
+        def _us(value):
+            return None if value is None else round(value * 1e6, 1)
+
+        return {
+            "sample_every": self.sample_every,
+            "stages": {
+                stage: {
+                    "count": hist.count,
+                    "p50_us": _us(hist.percentile(0.5)),
+                    "p99_us": _us(hist.percentile(0.99)),
+                    "max_us": _us(hist.max if hist.count else None),
+                }
+                for stage, hist in self.stages.items()
+            },
+            "slowest_callbacks": [
+                {"name": name, "max_ms": round(seconds * 1000, 3)}
+                for name, seconds in sorted(
+                    self.callbacks.items(), key=lambda item: item[1], reverse=True
+                )[: self.slowest]
+            ],
+        }
+
+
+class AckTracker:
+    """跟踪指令的回复并统计往返时间(从写入 socket 到收到对应的更新帧).
+
+    超时从帧真正写出时开始计算, 排队的时间不算在内. 超时的 future 会抛出 asyncio.TimeoutError.
+    """
+
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+        # 设备地址 -> 已发出, 等待回复的指令(按发送顺序)
+        self._waiting: Dict[int, List[PendingAck]] = {}
+        # 统计信息
+        self.acked = 0
+        self.timeouts = 0
+        self.last_rtt: Union[float, None] = None
+        self.total_rtt = 0.0
+        self.max_rtt = 0.0
+        self.rtt_histogram = Histogram()
+
+    @staticmethod
+    def parse(data: bytes) -> Tuple[int, int]:
+        """从编码好的帧中取出 (功能码, 设备地址)"""
+        start_at = 3 if data[0] == TypeCode.COVER.value else 2
+        return data[start_at], int.from_bytes(data[start_at + 1 : start_at + 5], "big")
+
+    def expect(self, data: bytes) -> Union[PendingAck, None]:
+        func_code, addr = self.parse(data)
+        expected = ACK_FUNC_CODES.get(func_code)
+        if expected is None:
+            return None
+        return PendingAck(addr, expected)
+
+    def sent(self, ack: PendingAck, now: float):
+        ack.sent_at = now
+        self._waiting.setdefault(ack.addr, []).append(ack)
+        ack.timer = asyncio.get_running_loop().call_later(
+            self.timeout, self._expire, ack
+        )
+
+    def _expire(self, ack: PendingAck):
+        waiting = self._waiting.get(ack.addr)
+        if waiting and ack in waiting:
+            waiting.remove(ack)
+            if not waiting:
+                del self._waiting[ack.addr]
+        self.timeouts += 1
+        ack.set_exception(asyncio.TimeoutError())
+
+    def resolve(self, addr: int, func_code: FuncCode) -> Union[float, None]:
+        """收到设备的更新帧, 返回最早一条匹配指令的往返时间"""
+        waiting = self._waiting.get(addr)
+        if not waiting:
+            return None
+        value = func_code.value
+        for index, ack in enumerate(waiting):
+            if value in ack.expected:
+                break
+        else:
+            return None
+        del waiting[index]
+        if not waiting:
+            del self._waiting[addr]
+        ack.timer.cancel()
+        rtt = time.monotonic() - ack.sent_at
+        self.acked += 1
+        self.last_rtt = rtt
+        self.total_rtt += rtt
+        if rtt > self.max_rtt:
+            self.max_rtt = rtt
+        self.rtt_histogram.observe(rtt)
+        ack.set_result(rtt)
+        return rtt
+
+    def cancel_all(self):
+        for waiting in self._waiting.values():
+            for ack in waiting:
+                ack.cancel()
+        self._waiting.clear()
+
+    def stats(self) -> dict:
+        return {
+            "acked": self.acked,
+            "timeouts": self.timeouts,
+            "last_rtt": self.last_rtt,
+            "avg_rtt": self.total_rtt / self.acked if self.acked else None,
+            "max_rtt": self.max_rtt,
+            "rtt_histogram": self.rtt_histogram.stats(),
+        }
+
+
+class OutboundFrame:
+    """排队中的待发送帧"""
+
+    __slots__ = ("data", "enqueued_at", "key", "priority", "ack", "count")
+
+    def __init__(
+        self,
+        data: bytes,
+        enqueued_at: float,
+        key,
+        priority: int,
+        ack: Union[PendingAck, None] = None,
+        count: int = 1,
+    ):
+        self.data = data
+        # data 中包含的帧数(编译好的场景一次提交多个帧), 限速按帧数计算
+        self.count = count
+        self.enqueued_at = enqueued_at
+        # (设备地址, 指令类别), 为 None 时不参与合并
+        self.key = key
+        self.priority = priority
+        # 需要等待网关回复时不为 None
+        self.ack = ack
+
+
+class CommandScheduler:
+    """发送调度器.
+
+    网关被大量指令淹没时会丢指令, 所以所有发出去的帧都先进入队列, 由一个后台任务按速率发出:
+        - rate: 每秒最多发送的帧数(令牌桶, 桶容量为 burst, 一个场景的帧可以在一次写入中发出)
+        - min_gap: 俩次写入之间的最小间隔(秒)
+        - 俩个优先级队列, 高优先级队列清空之前不会发送低优先级的帧
+    同一时刻已经排队的帧会拼接成一次写入.
+
+    提交时带 key 的帧, 如果队列里已有相同 key 且尚未发出的帧, 则直接替换旧帧的内容(保留原来的排队位置).
+    比如拖动窗帘滑块时只会发出最后的位置, 不会追着每一个中间值跑.
+    拼接好的多个帧(场景)没有 key, 提交时用 fence 列出其中设备指令的 key: 排在它前面的同 key 帧不再被替换,
+    之后的指令排在场景后面, 保证设备最终执行的是最后一次操作.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[bytes], None],
+        rate: float = 20.0,
+        min_gap: float = 0.0,
+        burst: Union[int, None] = None,
+        on_sent: Union[Callable[[PendingAck, float], None], None] = None,
+    ):
+        self._write = write
+        # 帧写出之后的回调, 用于开始计算指令的往返时间
+        self._on_sent = on_sent
+        self.rate = max(rate, 0.1)
+        self.min_gap = max(min_gap, 0.0)
+        self.burst = burst or max(int(self.rate), 1)
+        self._lanes = (deque(), deque())
+        # key -> 尚未发出的帧
+        self._pending: Dict[Hashable, OutboundFrame] = {}
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._written_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._writable = False
+        self._task: Union[asyncio.Task, None] = None
+        # 统计信息
+        self.frames_sent = 0
+        self.writes = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.superseded = 0
+
+    @property
+    def depth(self) -> int:
+        """队列中等待发送的条目数(一个编译好的场景算一条)"""
+        return len(self._lanes[0]) + len(self._lanes[1])
+
+    def stats(self) -> dict:
+        return {
+            "depth_high": len(self._lanes[PRIORITY_HIGH]),
+            "depth_low": len(self._lanes[PRIORITY_LOW]),
+            "frames_sent": self.frames_sent,
+            "writes": self.writes,
+            "avg_wait": self.total_wait / self.frames_sent if self.frames_sent else 0.0,
+            "max_wait": self.max_wait,
+            "superseded": self.superseded,
+        }
+
+    def submit(
+        self,
+        data: bytes,
+        priority: int = PRIORITY_HIGH,
+        key: Union[Hashable, None] = None,
+        ack: Union[PendingAck, None] = None,
+        count: int = 1,
+        fence: Iterable[Hashable] = (),
+    ):
+        for fenced in fence:
+            self._pending.pop(fenced, None)
+        if key is not None:
+            item = self._pending.get(key)
+            if item is not None and item.priority == priority:
+                item.data = data
+                if ack is None and item.ack is not None:
+                    # 帧的内容变了, 等待的回复也要跟着变, 否则旧的 future 永远等不到匹配的回复
+                    expected = ACK_FUNC_CODES.get(AckTracker.parse(data)[0])
+                    if expected is None:
+                        item.ack.cancel()
+                        item.ack = None
+                    else:
+                        item.ack.expected = expected
+                elif ack is not None:
+                    if item.ack is None:
+                        item.ack = ack
+                    else:
+                        item.ack.expected = ack.expected
+                        item.ack.futures.extend(ack.futures)
+                self.superseded += 1
+                return
+        item = OutboundFrame(data, time.monotonic(), key, priority, ack, count)
+        self._lanes[priority].append(item)
+        if key is not None:
+            self._pending[key] = item
+        self._wakeup.set()
+
+    def configure(self, rate: float, min_gap: float):
+        """运行中修改限速, 已经攒下的令牌不会超过新的桶容量"""
+        self.rate = max(rate, 0.1)
+        self.min_gap = max(min_gap, 0.0)
+        self.burst = max(int(self.rate), 1)
+        self._tokens = min(self._tokens, float(self.burst))
+        self._wakeup.set()
+
+    def set_writable(self, writable: bool):
+        """连接建立/断开时调用, 断开期间帧会一直留在队列中"""
+        self._writable = writable
+        if writable:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def clear(self):
+        for lane in self._lanes:
+            for item in lane:
+                if item.ack is not None:
+                    item.ack.cancel()
+            lane.clear()
+        self._pending.clear()
+
+    def discard(self, keys) -> int:
+        """丢掉还在排队的这些 key 的指令, 设备被删除时用, 返回丢掉的帧数"""
+        items = [self._pending.pop(key, None) for key in keys]
+        items = [item for item in items if item is not None]
+        dropped = 0
+        for item in items:
+            self._lanes[item.priority].remove(item)
+            dropped += item.count
+            if item.ack is not None:
+                item.ack.cancel()
+        return dropped
+
+    def _refill(self, now: float):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._refilled_at) * self.rate
+        )
+        self._refilled_at = now
+
+    async def _run(self):
+        while True:
+            if not self._writable or not self.depth:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            delay = max(
+                (1 - self._tokens) / self.rate, self._written_at + self.min_gap - now
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._flush(now)
+
+    def _flush(self, now: float):
+        budget = int(self._tokens)
+        chunk = []
+        acks = []
+        sent = 0
+        for lane in self._lanes:
+            # 超过桶容量的场景也要能发出去, 透支的令牌会推迟之后的写入
+            while lane and (sent + lane[0].count <= budget or not chunk):
+                item = lane.popleft()
+                sent += item.count
+                if item.key is not None and self._pending.get(item.key) is item:
+                    del self._pending[item.key]
+                wait = now - item.enqueued_at
+                self.total_wait += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+                chunk.append(item.data)
+                if item.ack is not None:
+                    acks.append(item.ack)
+        self._tokens -= sent
+        self._written_at = now
+        self.frames_sent += sent
+        self.writes += 1
+        self._write(b"".join(chunk))
+        if self._on_sent is not None:
+            for ack in acks:
+                self._on_sent(ack, now)
+
+
+class CoverMotion:
+    """窗帘运动模型.
+
+    窗帘移动时网关会陆续回复中间位置, 根据这些回复学习窗帘从全关到全开的时间(travel_time),
+    移动过程中按学到的速度在本地插值位置, 界面按固定频率刷新, 不用每收到一帧就写一次状态.
+    时间都是 time.monotonic().
+    """
+
+    __slots__ = (
+        "travel_time",
+        "origin",
+        "started_at",
+        "anchor",
+        "anchor_at",
+        "target",
+    )
+
+    # 学习的时间范围(秒), 超出范围的样本认为是网关直接回复了结果, 不参与学习
+    MIN_TRAVEL_TIME = 3.0
+    MAX_TRAVEL_TIME = 120.0
+    # 新样本的权重
+    LEARN_RATE = 0.3
+    # 预计到达之后再等多久还没有到位, 就认为运动结束(比如被手动停止)
+    GRACE = 3.0
+
+    def __init__(self, travel_time: float = 30.0):
+        self.travel_time = travel_time
+        self.origin: Union[int, None] = None  # 本次运动的起点
+        self.started_at: Union[float, None] = None
+        self.anchor: Union[int, None] = None  # 最近一次确认的位置
+        self.anchor_at: Union[float, None] = None
+        self.target: Union[int, None] = None
+
+    @property
+    def moving(self) -> bool:
+        return self.target is not None
+
+    @property
+    def direction(self) -> int:
+        """1 打开中, -1 关闭中, 0 静止"""
+        if self.target is None or self.target == self.anchor:
+            return 0
+        return 1 if self.target > self.anchor else -1
+
+    def start(self, position: int, target: int, now: float):
+        if position == target:
+            self.stop()
+            return
+        self.origin = self.anchor = position
+        self.started_at = self.anchor_at = now
+        self.target = target
+
+    def stop(self):
+        self.target = None
+
+    def observe(self, position: int, now: float) -> bool:
+        """网关回复了位置, 返回窗帘是否还在移动"""
+        if self.target is None:
+            return False
+        distance = abs(position - self.origin)
+        elapsed = now - self.started_at
+        if distance >= 5 and elapsed > 0:
+            travel_time = elapsed * 100 / distance
+            if self.MIN_TRAVEL_TIME <= travel_time <= self.MAX_TRAVEL_TIME:
+                self.travel_time += self.LEARN_RATE * (travel_time - self.travel_time)
+        self.anchor, self.anchor_at = position, now
+        if position == self.target:
+            self.stop()
+            return False
+        return True
+
+    def position(self, now: float) -> Union[int, None]:
+        """当前的插值位置, 不会越过目标位置"""
+        if self.target is None:
+            return self.anchor
+        moved = (now - self.anchor_at) * 100 / self.travel_time
+        if self.target > self.anchor:
+            return int(min(self.anchor + moved, self.target))
+        return int(max(self.anchor - moved, self.target))
+
+    def expired(self, now: float) -> bool:
+        """按学到的速度早就应该到位了"""
+        if self.target is None:
+            return True
+        remaining = abs(self.target - self.anchor) * self.travel_time / 100
+        return now > self.anchor_at + remaining + self.GRACE
+
+
+# 飞行记录器中数据的方向
+RECORD_RX = 0
+RECORD_TX = 1
+
+
+class FlightRecorder:
+    """收发数据的环形缓冲区, 记录最近 capacity 次读写(每次读写可能包含多个帧).
+
+    缓冲区预先分配好, 记录时只保存方向/时间戳以及原始 bytes 的引用, 不做任何格式化.
+    需要排查问题时通过 dump() 按需格式化, 比如 hass 的诊断信息下载.
+    """
+
+    __slots__ = ("capacity", "_dirs", "_times", "_data", "_pos", "total")
+
+    def __init__(self, capacity: int = 2048):
+        self.capacity = capacity
+        self._dirs = bytearray(capacity)
+        self._times = array("d", bytes(8 * capacity))
+        self._data: List[bytes] = [b""] * capacity
+        self._pos = 0
+        self.total = 0
+
+    def record(self, direction: int, data: bytes):
+        pos = self._pos
+        self._dirs[pos] = direction
+        self._times[pos] = time.monotonic()
+        self._data[pos] = data
+        self._pos = pos + 1 if pos + 1 < self.capacity else 0
+        self.total += 1
+
+    def entries(self) -> List[Tuple[int, float, bytes]]:
+        """按时间顺序返回 (方向, monotonic 时间戳, 原始数据)"""
+        size = min(self.total, self.capacity)
+        start = (self._pos - size) % self.capacity
+        return [
+            (self._dirs[i], self._times[i], self._data[i])
+            for i in ((start + n) % self.capacity for n in range(size))
+        ]
+
+    def dump(self) -> List[dict]:
+        """格式化所有记录, 同时按方向解析出其中的帧"""
+        now, wall = time.monotonic(), time.time()
+        decoders = {RECORD_RX: FrameDecoder(), RECORD_TX: FrameDecoder()}
+        return [
+            {
+                "time": round(wall - (now - at), 3),
+                "dir": "tx" if direction == RECORD_TX else "rx",
+                "raw": bytes_debug_str(data),
+                "frames": [str(frame) for frame in decoders[direction].feed(data)],
+            }
+            for direction, at, data in self.entries()
+        ]
+
+
+class ConnectionState(enum.Enum):
+    """网关连接状态"""
+
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    # 连接失败或断开, 等待一段时间后重连
+    BACKOFF = "backoff"
+
+
+class DeoceanProtocol(asyncio.Protocol):
+    """asyncio 的连接协议, 所有回调都在事件循环中执行, 直接转交给网关处理"""
+
+    def __init__(self, gw: DeoceanGateway):
+        self.gw = gw
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.gw._connection_made(transport)
+
+    def data_received(self, data: bytes):
+        self.gw._data_received(data)
+
+    def connection_lost(self, exc: Union[Exception, None]):
+        self.gw._connection_lost(exc)
+
+
 class DeoceanGateway:
     """
     该网关并没有文档，通过日志分析(/home/deocean_v2/log/ebelong.log)猜测分析的方式。所以不能保证所有指令方式都支持.
+
+    网关运行在 asyncio 事件循环中(hass 的 loop), 不再单独开线程.
+    除非特别说明, 所有方法都需要在事件循环中调用.
     """
 
-    def __init__(self, ip_addr: str, port: int = 9999, timeout: int = None):
+    def __init__(
+        self,
+        ip_addr: str,
+        port: int = 9999,
+        timeout: int = None,
+        nodelay: bool = True,
+        send_rate: float = 20.0,
+        min_gap: float = 0.0,
+        reconcile_rate: float = 0,
+        reconcile_max_age: float = 600.0,
+    ):
         self.ip_addr = ip_addr
         self.port = port or 9999
-        self.sock = None
         self.devices: Dict[str, DeoceanDevice] = {}
         # 场景配置.
         # 每一个key都是对应场景配置的addr
         # 值就是需要执行的操作.
         self.scenes: dict[str, SceneTask] = {}
+        # 场景只给状态需要改变的设备发指令(状态未知或者超过 scene_diff_max_age 秒没有回复的设备照常发送)
+        self.scene_diff = False
+        self.scene_diff_max_age = 600.0
+        self.scene_frames_skipped = 0
+        # 设备增删时加一, 编译好的场景据此判断是否需要重新编译
+        self.devices_version = 0
+        # 收包路由表, key 为 4 字节地址对应的整数, 值为设备或者面板的 {channel: 场景}.
+        # 收到一帧只需要查一到两次字典, 不用再格式化地址字符串
+        self._dispatch: Dict[int, Union[DeoceanDevice, Dict[int, SceneTask]]] = {}
         self._listening = False
-        self._thread = None
-        self.max_retry = 5
+        self._transport: Union[asyncio.Transport, None] = None
+        self._connect_lock = asyncio.Lock()
         self.timeout = timeout or 60
+        # 连接状态机. 断线后由后台任务按指数退避(带随机抖动)重连, 发送方永远不会等待重连
+        self.state = ConnectionState.DISCONNECTED
+        self._connection_task: Union[asyncio.Task, None] = None
+        self._lost = asyncio.Event()
+        self.backoff_base = 1.0
+        self.backoff_max = 60.0
+        # 断线期间队列中最多保留的帧数, 超过后直接拒绝
+        self.max_queue = 256
+        # 重连统计: 成功重连次数以及最近的状态变化 (时间戳, 状态, 原因)
+        self.reconnects = 0
+        self.connection_events: Deque[Tuple[float, str, str]] = deque(maxlen=32)
+        # 启动时的状态同步
+        self._sync_duration: Union[float, None] = None
+        # 设备状态有变化(收到网关回复)时调用, 用于持久化状态快照
+        self.state_listener: Union[Callable[[], None], None] = None
+        # 状态发布: 收包时只把设备标记为脏, 每一轮事件循环统一回调一次.
+        # 场景触发几十个设备回复时, 每个实体每轮最多写一次状态
+        self._dirty: Dict[int, DeoceanDevice] = {}
+        self._seen = False  # 本轮是否收到过设备回复(快照需要更新)
+        self._publish_scheduled = False
+        self.publish_flushes = 0
+        self.publish_updates = 0  # 设备回调的次数
+        self.publish_marks = 0  # 标记为脏的次数, 与上面的差就是合并掉的回调
+        # 正在移动的窗帘, 按 motion_interval 秒的间隔刷新插值位置
+        self.motion_interval = 1.0
+        self._moving: Dict[int, DeoceanDevice] = {}
+        self._motion_handle: Union[asyncio.TimerHandle, None] = None
+        # 每个连接一个解帧器, 用于拼接被拆开的 TCP 数据
+        self._decoder = FrameDecoder()
+        # 最近收发的原始数据, 代替逐帧的调试日志
+        self.recorder = FlightRecorder()
+        # 统计信息. 所有的记录都在事件循环中进行, 不需要加锁
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.unknown_frames = 0  # 地址既不是设备也不是面板的帧
+        # 面板按键: 不管有没有配置场景, 每次按键都会回调 panel_listener(事件数据),
+        # 事件数据按 (地址, channel) 缓存, 按键时不需要再格式化. panel_event_base 会合并到每个事件数据中
+        self.panel_listener: Union[Callable[[dict], None], None] = None
+        self.panel_event_base: dict = {}
+        self._panel_events: Dict[int, dict] = {}
+        self.panel_presses = 0
+        # 收到数据到回调 panel_listener 的耗时(包括执行场景)
+        self.press_latency = Histogram(StageProfiler.BOUNDS)
+        self._rx_at = 0.0
+        # 耗时采样, 默认关闭, 参见 set_profiling
+        self.profiler: Union[StageProfiler, None] = None
+        self._profiling: Union[StageProfiler, None] = None  # 本次读取正在计时
+        # 是否关闭 Nagle 算法, 关闭后小包立即发出
+        self.nodelay = nodelay
+        # batch() 期间收集到的 (帧, 优先级, key, ack, 帧数, fence), 退出时一次性提交
+        self._batch: Union[List[tuple], None] = None
+        # 指令回复的等待以及往返时间统计
+        self.acks = AckTracker()
+        # 所有发出的帧都经过调度器限速
+        self.scheduler = CommandScheduler(
+            self._write, send_rate, min_gap, on_sent=self.acks.sent
+        )
+        # 后台对账: 每分钟最多发送 reconcile_rate 个 sync 帧(0 表示关闭),
+        # 超过 reconcile_max_age 秒没有回复的设备才会被同步
+        self.reconcile_rate = reconcile_rate
+        self.reconcile_max_age = reconcile_max_age
+        self._reconcile_task: Union[asyncio.Task, None] = None
+        # 对账最近一次同步每个设备的时间, key 同 devices
+        self._reconciled_at: Dict[int, float] = {}
+        self.reconcile_sent = 0
 
     def __get_socket(self) -> socket.socket:
         """
-        工具函数,打开一个连接好的Socket.
+        工具函数,创建一个非阻塞的Socket, 由事件循环负责连接.
         """
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if platform in ("linux", "linux2"):
@@ -100,83 +831,349 @@ class DeoceanGateway:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 3)
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-        s.settimeout(self.timeout)
-        s.connect((self.ip_addr, self.port))
+        s.setblocking(False)
         return s
 
-    def open_socket(self):
-        if self.sock:
-            self.sock.close()
-            self.sock = None
-            time.sleep(1)
+    @property
+    def unique_id(self) -> str:
+        """网关的唯一标识, 一个 hass 可以有多个网关, 设备的 unique_id 以此为前缀避免地址冲突"""
+        return f"{self.ip_addr}:{self.port}"
 
-        self.sock = self.__get_socket()
-        return self.sock
+    @property
+    def connected(self) -> bool:
+        return self._transport is not None
 
-    def _listen_to_msg(self):
+    def _set_state(self, state: ConnectionState, reason: str = ""):
+        if state == self.state:
+            return
+        _LOGGER.debug(f"网关连接状态: {self.state.value} -> {state.value} {reason}")
+        self.state = state
+        self.connection_events.append((time.time(), state.value, reason))
+
+    def connection_stats(self) -> dict:
+        return {
+            "state": self.state.value,
+            "reconnects": self.reconnects,
+            "events": list(self.connection_events),
+        }
+
+    async def async_connect(self):
+        """建立到网关的连接, 超时或者失败时抛出 OSError/asyncio.TimeoutError"""
+        async with self._connect_lock:
+            if self._transport is not None:
+                return
+            self._set_state(ConnectionState.CONNECTING)
+            loop = asyncio.get_running_loop()
+            sock = self.__get_socket()
+            try:
+                await asyncio.wait_for(
+                    loop.sock_connect(sock, (self.ip_addr, self.port)), self.timeout
+                )
+                await loop.create_connection(lambda: DeoceanProtocol(self), sock=sock)
+            except BaseException as e:
+                sock.close()
+                self._set_state(ConnectionState.DISCONNECTED, repr(e))
+                raise
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """指数退避, 一半固定一半随机, 避免网关重启后所有客户端同时重连"""
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _async_maintain_connection(self):
+        """连接状态机: connected -> (断开) -> backoff -> connecting -> connected"""
+        attempt = 0
         while self._listening:
-            data = self._get_data()
-            if not data:
-                time.sleep(0.1)
+            if self._transport is not None:
+                self._lost.clear()
+                await self._lost.wait()
                 continue
+            delay = self._backoff_delay(attempt)
+            self._set_state(ConnectionState.BACKOFF, f"{delay:.1f}s")
+            await asyncio.sleep(delay)
+            try:
+                await self.async_connect()
+            except (OSError, asyncio.TimeoutError) as e:
+                attempt += 1
+                _LOGGER.warning(f"重连网关失败(第{attempt}次): {e}")
+            else:
+                attempt = 0
+                self.reconnects += 1
+
+    def _connection_made(self, transport: asyncio.Transport):
+        _LOGGER.debug(f"已连接网关 {self.ip_addr}:{self.port}")
+        # 新连接不能沿用旧连接残留的半个帧
+        self._decoder.reset()
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0
+            )
+        self._transport = transport
+        self._set_state(ConnectionState.CONNECTED)
+        self.scheduler.start()
+        self.scheduler.set_writable(True)
+
+    def _connection_lost(self, exc: Union[Exception, None]):
+        _LOGGER.debug(f"网关连接断开: {exc}")
+        self._transport = None
+        self._set_state(ConnectionState.DISCONNECTED, repr(exc))
+        self.scheduler.set_writable(False)
+        self._lost.set()
+
+    def _data_received(self, data: bytes):
+        # 原始数据只记录到飞行记录器, 需要时再格式化(诊断信息)
+        self._rx_at = time.perf_counter()
+        self.recorder.record(RECORD_RX, data)
+        self.bytes_received += len(data)
+        profiler = self.profiler
+        if profiler is not None and profiler.sample(StageProfiler.SITE_READ):
+            self._data_received_profiled(data, profiler)
+            return
+        for frame in self._decoder.feed(data):
+            self._handle_frame(frame)
+
+    def _data_received_profiled(self, data: bytes, profiler: StageProfiler):
+        """同 _data_received, 但是记录每个阶段的耗时"""
+        started = time.perf_counter()
+        frames = self._decoder.feed(data)
+        decoded = time.perf_counter()
+        profiler.observe("decode", decoded - started)
+        self._profiling = profiler
+        try:
+            for frame in frames:
+                profiler.update_spent = 0.0
+                begin = time.perf_counter()
+                self._handle_frame(frame)
+                profiler.observe(
+                    "dispatch", time.perf_counter() - begin - profiler.update_spent
+                )
+        finally:
+            self._profiling = None
+        profiler.observe("read", time.perf_counter() - started)
+
+    def set_profiling(self, enabled: bool, sample_every: int = 8):
+        """打开/关闭耗时采样, 重新打开时清空之前的数据"""
+        self.profiler = StageProfiler(sample_every) if enabled else None
+
+    def profiling_report(self) -> Union[dict, None]:
+        return self.profiler.report() if self.profiler is not None else None
+
+    def _handle_frame(self, frame: DeoceanData):
+        # 没有设备, 跳过
+        if not frame.device_address:
+            return
+        if frame.func_code == FuncCode.SEARCH:
+            # 搜索貌似没有鸟用
+            return
+        mac = frame.device_address.mac_address
+        target = self._dispatch.get(mac)
+        # 这里只会找到灯或者窗帘(被添加进去的设备)
+        if isinstance(target, DeoceanDevice):
+            device = target
+            if frame.func_code in (FuncCode.SWITCH_UPDATED, FuncCode.POSITION_UPDATED):
+                self.acks.resolve(mac, frame.func_code)
+            kwargs = {}
+            if frame.position is not None:
+                kwargs["position"] = frame.position
+            # 开关状态
+            if frame.ctrl_code in [
+                ControlCode.COVER_OFF,
+                ControlCode.COVER_ON,
+                ControlCode.LIGHT_OFF,
+                ControlCode.LIGHT_ON,
+            ]:
+                kwargs["switch_status"] = frame.ctrl_code.name
+                # 对于窗帘，如果没有明确的位置信息，根据开关状态推断位置.
+                # 正在移动时不推断: 0C 只是指令的确认, 窗帘还没有到位, 推断的位置会直接结束插值.
+                # 运动结束(到位的回复或者超时之后的 sync)时才会拿到真实位置
+                if (
+                    device.type == TypeCode.COVER
+                    and frame.position is None
+                    and not device.motion.moving
+                ):
+                    if frame.ctrl_code == ControlCode.COVER_ON:
+                        kwargs["position"] = 100
+                    elif frame.ctrl_code == ControlCode.COVER_OFF:
+                        kwargs["position"] = 0
+            # 如果有任何更新内容，就调用update
+            if kwargs:
+                profiling = self._profiling
+                if profiling is not None:
+                    begin = time.perf_counter()
+                try:
+                    device.update(**kwargs)
+                except Exception as e:
+                    _LOGGER.error(f"设备状态更新失败 {device.name}: {e}")
+                if profiling is not None:
+                    spent = time.perf_counter() - begin
+                    profiling.update_spent += spent
+                    profiling.observe("update", spent)
+                self._seen = True
+                self._schedule_publish()
+        elif frame.channel is not None:
+            self._panel_press(mac, frame.channel, target)
+        else:
+            self.unknown_frames += 1
 
-            # 打印原始十六进制数据
-            raw_hex = " ".join([f"{x:02X}" for x in data])
-            _LOGGER.debug(f"收到原始数据: {raw_hex}")
+    def _panel_press(self, mac: int, channel: int, panel: Union[dict, None]):
+        """面板按键: 先执行本地场景(延迟最低), 再通知 panel_listener"""
+        self.panel_presses += 1
+        scene_task = panel.get(channel) if panel is not None else None
+        if scene_task and callable(scene_task.action):
+            try:
+                # 一个场景触发的所有指令合并成一次写入
+                with self.batch():
+                    scene_task.action()
+            except Exception as e:
+                _LOGGER.error(f"场景执行失败 {scene_task.name}: {e}")
+        if self.panel_listener is None:
+            return
+        key = mac << 8 | channel
+        event = self._panel_events.get(key)
+        if event is None:
+            button = self.generate_scene_id(mac, channel)
+            event = self._panel_events[key] = {
+                **self.panel_event_base,
+                "button": button,
+                "address": f"{mac:08X}",
+                "channel": channel,
+                "scene": scene_task.name if scene_task else None,
+            }
+        try:
+            self.panel_listener(event)
+        except Exception as e:
+            _LOGGER.error(f"面板按键回调失败 {event['button']}: {e}")
+        self.press_latency.observe(time.perf_counter() - self._rx_at)
+
+    def panel_buttons(self) -> List[str]:
+        """已知的面板按键(配置了场景或者按过的), 格式同 generate_scene_id"""
+        buttons = set(self.scenes)
+        buttons.update(event["button"] for event in self._panel_events.values())
+        return sorted(buttons)
+
+    def mark_dirty(self, device: "DeoceanDevice"):
+        """标记设备状态有变化, 在本轮事件循环结束后统一回调"""
+        self.publish_marks += 1
+        self._dirty[device.addr.mac_address] = device
+        self._schedule_publish()
+
+    def _schedule_publish(self):
+        if self._publish_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中(比如直接调用的测试代码), 立即回调
+            self._publish()
+            return
+        self._publish_scheduled = True
+        loop.call_soon(self._publish)
 
-            for frame in parse_data(data):
-                # 显示原始数据和解析后的帧信息
-                _LOGGER.debug(f"原始数据: {bytes_debug_str(data)}")
-                _LOGGER.debug(f"解析帧: {frame}")
+    def _publish(self):
+        self._publish_scheduled = False
+        dirty, self._dirty = self._dirty, {}
+        if dirty:
+            self.publish_flushes += 1
+            self.publish_updates += len(dirty)
+        profiler = self.profiler
+        if (
+            profiler is not None
+            and dirty
+            and profiler.sample(StageProfiler.SITE_PUBLISH)
+        ):
+            self._publish_profiled(dirty.values(), profiler)
+            dirty = {}
+        for device in dirty.values():
+            try:
+                batch_action(device.status_callback, device)
+            except Exception as e:
+                _LOGGER.error(f"设备状态回调失败 {device.name}: {e}")
+        if self._seen:
+            self._seen = False
+            if self.state_listener is not None:
+                self.state_listener()
 
-                # 没有设备, 跳过
-                if not frame.device_address:
-                    continue
-                if frame.func_code == FuncCode.SEARCH:
-                    # 搜索貌似没有鸟用
+    @staticmethod
+    def _publish_profiled(devices: Iterable["DeoceanDevice"], profiler: StageProfiler):
+        """逐个回调计时, 记录回调名称方便找出慢的实体"""
+        for device in devices:
+            for callback in device.status_callback:
+                if not callable(callback):
                     continue
-                device = self.get_device(frame.device_address)
-
-                # 如果找到设备，记录设备信息
-                if device:
-                    _LOGGER.debug(f"找到设备: {device.name} (type={device.type.name})")
-                # 这里只会找到灯或者窗帘(被添加进去的设备)
-                if device:
-                    kwargs = {}
-                    if frame.position is not None:
-                        kwargs["position"] = frame.position
-                    # 开关状态
-                    if frame.ctrl_code in [
-                        ControlCode.COVER_OFF,
-                        ControlCode.COVER_ON,
-                        ControlCode.LIGHT_OFF,
-                        ControlCode.LIGHT_ON,
-                    ]:
-                        kwargs["switch_status"] = frame.ctrl_code.name
-                        # 对于窗帘，如果没有明确的位置信息，根据开关状态推断位置
-                        if device.type == TypeCode.COVER and frame.position is None:
-                            if frame.ctrl_code == ControlCode.COVER_ON:
-                                kwargs["position"] = 100
-                            elif frame.ctrl_code == ControlCode.COVER_OFF:
-                                kwargs["position"] = 0
-                    # 如果有任何更新内容，就调用update
-                    if kwargs:
-                        _LOGGER.debug(f"更新设备状态: {device.name} -> {kwargs}")
-                        try:
-                            device.update(**kwargs)
-                        except Exception as e:
-                            _LOGGER.error(f"设备状态更新失败 {device.name}: {e}")
-                elif frame.channel is not None:
-                    scene_task = self.scenes.get(
-                        self.generate_scene_id(
-                            frame.device_address.mac_address, frame.channel
-                        )
-                    )
-                    if scene_task and callable(scene_task.action):
-                        try:
-                            scene_task.action()
-                        except Exception as e:
-                            _LOGGER.error(f"场景执行失败 {scene_task.name}: {e}")
+                begin = time.perf_counter()
+                try:
+                    callback(device)
+                except Exception as e:
+                    _LOGGER.error(f"设备状态回调失败 {device.name}: {e}")
+                name = getattr(callback, "__qualname__", repr(callback))
+                profiler.observe_callback(
+                    f"{name}[{device.name}]", time.perf_counter() - begin
+                )
+
+    def track_motion(self, device: "DeoceanDevice"):
+        """窗帘开始移动, 在移动过程中定时刷新插值位置"""
+        self._moving[device.addr.mac_address] = device
+        if self._motion_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # 不在事件循环中, 不插值
+            self._motion_handle = loop.call_later(
+                self.motion_interval, self._motion_tick
+            )
+
+    def _motion_tick(self):
+        self._motion_handle = None
+        now = time.monotonic()
+        for mac, device in list(self._moving.items()):
+            motion = device.motion
+            if not motion.moving:
+                del self._moving[mac]
+                continue
+            if motion.expired(now):
+                # 一直没有到位的回复, 停止插值并查询一次真实位置
+                motion.stop()
+                del self._moving[mac]
+                device.sync()
+            self.mark_dirty(device)
+        if self._moving:
+            self._motion_handle = asyncio.get_running_loop().call_later(
+                self.motion_interval, self._motion_tick
+            )
+
+    @staticmethod
+    def _ms(seconds: Union[float, None], digits: int = 1) -> Union[float, None]:
+        return None if seconds is None else round(seconds * 1000, digits)
+
+    def metrics(self) -> dict:
+        """运行指标, 供 hass 的诊断传感器读取. 往返时间/按键延迟单位为毫秒"""
+        rtt = self.acks.rtt_histogram
+        p50, p99 = rtt.percentile(0.5), rtt.percentile(0.99)
+        return {
+            "frames_received": self._decoder.frames,
+            "frames_sent": self.scheduler.frames_sent,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "parse_failures": self._decoder.dropped,
+            "resync_skips": self._decoder.skipped,
+            "unknown_frames": self.unknown_frames,
+            "reconnects": self.reconnects,
+            "send_timeouts": self.acks.timeouts,
+            "queue_depth": self.scheduler.depth,
+            "scene_frames_skipped": self.scene_frames_skipped,
+            "rtt_p50": self._ms(p50),
+            "rtt_p99": self._ms(p99),
+            "panel_presses": self.panel_presses,
+            "press_latency_p99": self._ms(self.press_latency.percentile(0.99), 3),
+        }
+
+    def publish_stats(self) -> dict:
+        return {
+            "flushes": self.publish_flushes,
+            "updates": self.publish_updates,
+            "coalesced": self.publish_marks - self.publish_updates - len(self._dirty),
+        }
 
     def generate_scene_id(self, addr: Addr, channel: int):
         """生成一个场景ID，场景ID由面板的唯一地址以及按键决定，按键在德能森里面叫channel.
@@ -210,7 +1207,7 @@ class DeoceanGateway:
             cover = DeoceanDevice(gw, 0xABCDEF, TypeCode.COVER, '客厅布帘')
             # 注册地址.
             gw.register_scene(0x44540400, 8, cover.toggle, '主卧床头布帘按键')
-            gw.start_listen()
+            await gw.async_start_listen()
 
         当gw收到消息发现是场景时，会自动触发cover.toggle API
         """
@@ -221,85 +1218,308 @@ class DeoceanGateway:
         id = self.generate_scene_id(addr, channel)
         if not force and id in self.scenes:
             raise "已有该场景"
-        self.scenes[id] = SceneTask(id, name or f"场景-{id}", action)
+        scene_task = self.scenes[id] = SceneTask(id, name or f"场景-{id}", action)
+        self._panel_events.clear()  # 事件数据中有场景名称, 需要重新生成
+        panel = self._dispatch.setdefault(toInt(addr), {})
+        # 面板地址和设备地址重复时按设备处理, 场景无效
+        if isinstance(panel, dict):
+            panel[channel] = scene_task
+
+    def unregister_scene(self, addr: Addr, channel: int) -> Union[SceneTask, None]:
+        """移除场景, 之后这个按键只会发出面板按键事件"""
+        scene_task = self.scenes.pop(self.generate_scene_id(addr, channel), None)
+        if scene_task is None:
+            return None
+        self._panel_events.clear()
+        key = toInt(addr)
+        panel = self._dispatch.get(key)
+        if isinstance(panel, dict):
+            panel.pop(channel, None)
+            if not panel:
+                del self._dispatch[key]
+        return scene_task
+
+    def apply_devices(
+        self, raw_txt: str
+    ) -> Tuple[List["DeoceanDevice"], List["DeoceanDevice"]]:
+        """按新的设备配置增量更新, 不影响网关连接, 返回 (新增的设备, 移除的设备).
+
+        只改了名字的设备原地改名(状态保留), 改了类型的设备先移除再重新添加.
+        编译好的场景按设备名查找设备, 设备有任何变化都会在下一次触发前重新编译.
+        """
+        wanted: Dict[int, Tuple[str, TypeCode]] = {}
+        for name, typ, addr in parse_device_str(raw_txt):
+            # 地址重复时和 register_devices 一样以第一个为准
+            wanted.setdefault(toInt(addr), (name, typ))
+        removed = []
+        for key, dev in list(self.devices.items()):
+            spec = wanted.get(key)
+            if spec is None or spec[1] != dev.type:
+                removed.append(self.remove_device(key))
+            elif spec[0] != dev.name:
+                dev.name = spec[0]
+                self.devices_version += 1
+                self.mark_dirty(dev)
+        added = [
+            DeoceanDevice(self, key, typ, name)
+            for key, (name, typ) in wanted.items()
+            if key not in self.devices
+        ]
+        return added, removed
 
-    def start_listen(self):
-        """Start listening."""
+    def apply_scenes(self, raw_txt: str) -> int:
+        """按新的场景配置增量更新, 只重新编译有变化的场景, 返回新增/修改/移除的场景数.
+
+        只管理由场景配置编译出来的场景(ScenePlan), 通过 register_scene 注册的其他回调不受影响.
+        """
+        wanted = {
+            self.generate_scene_id(scene.addr, scene.channel): scene
+            for scene in parse_scene_str(raw_txt)
+        }
+        changed = 0
+        for id, scene_task in list(self.scenes.items()):
+            plan = scene_task.action
+            if isinstance(plan, ScenePlan) and id not in wanted:
+                self.unregister_scene(plan.scene.addr, plan.scene.channel)
+                changed += 1
+        for id, scene in wanted.items():
+            current = self.scenes.get(id)
+            if (
+                current is not None
+                and isinstance(current.action, ScenePlan)
+                and current.action.scene == scene
+            ):
+                continue
+            plan = ScenePlan(self, scene)
+            plan.compile()
+            if len(plan):
+                self.register_scene(scene.addr, scene.channel, plan, scene.name, True)
+            elif current is not None:
+                # 场景里的设备都不存在了, 和 register_scenes 一样不注册
+                self.unregister_scene(scene.addr, scene.channel)
+            else:
+                continue
+            changed += 1
+        return changed
+
+    async def async_start_listen(self):
+        """连接网关并开始接收数据, 首次连接失败会抛出异常, 之后断线由后台自动重连"""
         if self._listening:
             return True
 
-        if self.sock is None:
-            self.open_socket()
-
+        await self.async_connect()
         self._listening = True
-        thread = Thread(target=self._listen_to_msg, args=())
-        self._thread = thread
-        thread.daemon = True
-        thread.start()
+        self._connection_task = asyncio.get_running_loop().create_task(
+            self._async_maintain_connection()
+        )
+        self.set_reconcile_rate(self.reconcile_rate)
         return True
 
-    def send(self, data: DeoceanData) -> None:
-        # 打印发送的原始十六进制数据
-        raw_data = data.encode()
-        raw_hex = " ".join([f"{x:02X}" for x in raw_data])
-        _LOGGER.debug(f"发送原始数据: {raw_hex}")
-
-        def _send(retry_count):
-            try:
-                if not self.sock:
-                    self.open_socket()
-                self.sock.settimeout(5.0)  # 减少超时时间
-                self.sock.send(raw_data)
-                self.sock.settimeout(None)
-
-            except socket.timeout:
-                _LOGGER.warning("发送数据超时")
+    def set_reconcile_rate(self, rate: float):
+        """运行中修改对账速率(每分钟最多同步次数), 0 表示关闭"""
+        if self._reconcile_task is not None:
+            if rate == self.reconcile_rate:
                 return
+            self._reconcile_task.cancel()
+            self._reconcile_task = None
+        self.reconcile_rate = rate
+        if self._listening and rate > 0:
+            self._reconcile_task = asyncio.get_running_loop().create_task(
+                self._async_reconcile()
+            )
+
+    async def _async_reconcile(self):
+        """按固定间隔每次同步一个最需要同步的设备, 所以总流量不会超过 reconcile_rate 帧/分钟"""
+        interval = 60.0 / self.reconcile_rate
+        while True:
+            await asyncio.sleep(interval)
+            if self.state != ConnectionState.CONNECTED:
+                continue
+            now = time.time()
+            device = self._reconcile_candidate(now)
+            if device is None:
+                continue
+            _LOGGER.debug(f"对账同步设备状态: {device}")
+            self._reconciled_at[device.addr.mac_address] = now
+            self.reconcile_sent += 1
+            device.sync()
 
-            except OSError as e:
-                _LOGGER.warning(f"发送数据失败: {e}")
-                if retry_count < self.max_retry:
-                    retry_count += 1
-                    try:
-                        self.open_socket()
-                        _send(retry_count)
-                    except Exception as ex:
-                        _LOGGER.error(f"重连失败: {ex}")
+    def _reconcile_candidate(self, now: float) -> Union["DeoceanDevice", None]:
+        """挑出最需要同步的设备.
+
+        发出指令之后一直没有收到回复的设备最优先, 其次是最久没有消息的设备.
+        同一个设备同步过一次之后, 要再过 reconcile_max_age 秒才会再同步, 避免离线的设备占满预算.
+        """
+        best, best_score = None, None
+        for addr, dev in self.devices.items():
+            last_checked = max(dev.last_seen or 0, self._reconciled_at.get(addr, 0))
+            if (
+                dev.last_command_at is not None
+                and last_checked < dev.last_command_at
+                and now - dev.last_command_at > self.acks.timeout
+            ):
+                score = (0, dev.last_command_at)
+            elif now - last_checked > self.reconcile_max_age:
+                score = (1, last_checked)
+            else:
+                continue
+            if best_score is None or score < best_score:
+                best, best_score = dev, score
+        return best
 
+    def send(
+        self,
+        data: Union[DeoceanData, bytes],
+        priority: int = PRIORITY_HIGH,
+        key: Union[Hashable, None] = None,
+        ack: bool = False,
+    ) -> Union[asyncio.Future, None]:
+        """发送数据, 帧进入调度器的队列后立即返回, 不会阻塞事件循环.
+
+        连接断开期间帧会留在队列中, 重连后再发出; 队列已满(max_queue)时直接丢弃, 不会等待重连.
+        在 batch() 中调用时会延迟到退出 batch() 时统一提交.
+        key 相同且尚未发出的帧会被新的帧替换, 参见 CommandScheduler.
+        ack 为 True 时返回一个 future, 收到该设备对应的更新帧(0B->0C, 1B->1C)时返回往返时间(秒),
+        超时则抛出 asyncio.TimeoutError.
+        """
+        # 设备指令已经是编码好的帧, 直接发送即可
+        raw_data = data if isinstance(data, bytes) else data.encode()
+        if self._transport is None and self.scheduler.depth >= self.max_queue:
+            _LOGGER.warning("网关未连接且发送队列已满, 丢弃指令")
+            if not ack:
+                return None
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(ConnectionError("网关未连接"))
+            return future
+        future = pending = None
+        if ack:
+            pending = self.acks.expect(raw_data)
+            if pending is not None:
+                future = asyncio.get_running_loop().create_future()
+                pending.futures.append(future)
+        if self._batch is not None:
+            self._batch.append((raw_data, priority, key, pending, 1, ()))
+        else:
+            self.scheduler.submit(raw_data, priority, key, pending)
+        return future
+
+    def send_buffer(
+        self,
+        data: bytes,
+        count: int,
+        priority: int = PRIORITY_HIGH,
+        keys: Iterable[Hashable] = (),
+    ):
+        """发送已经拼接好的 count 个帧(比如编译好的场景), 不参与合并, 也不等待回复.
+
+        keys 为其中设备指令的 key, 之后同 key 的指令不会替换掉排在场景前面的帧, 参见 CommandScheduler.
+        """
+        if self._transport is None and self.scheduler.depth >= self.max_queue:
+            _LOGGER.warning("网关未连接且发送队列已满, 丢弃指令")
+            return
+        if self._batch is not None:
+            self._batch.append((data, priority, None, None, count, keys))
+        else:
+            self.scheduler.submit(data, priority, None, None, count, keys)
+
+    def send_many(
+        self,
+        frames: Iterable[Union[DeoceanData, bytes]],
+        priority: int = PRIORITY_HIGH,
+        ack: bool = False,
+    ) -> List[asyncio.Future]:
+        """把多个帧一起提交, 调度器会尽量在一次写入中发出. ack 为 True 时返回每个帧的 future"""
+        futures = []
+        with self.batch():
+            for data in frames:
+                future = self.send(data, priority, ack=ack)
+                if future is not None:
+                    futures.append(future)
+        return futures
+
+    @contextmanager
+    def batch(self):
+        """合并发送, 期间所有 send 的帧会在退出时一起提交给调度器, 支持嵌套.
+
+        with gw.batch():
+            light.turn_off()
+            cover.turn_off()
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
         try:
-            _send(0)
-        except Exception as e:
-            _LOGGER.error(f"发送异常: {e}")
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            for raw_data, priority, key, pending, count, keys in batch:
+                self.scheduler.submit(raw_data, priority, key, pending, count, keys)
+
+    def _write(self, raw_data: bytes) -> None:
+        """由调度器调用, 真正写入 socket"""
+        self.recorder.record(RECORD_TX, raw_data)
+        self.bytes_sent += len(raw_data)
+        if self._transport is not None:
+            self._transport.write(raw_data)
+
+    async def async_send(
+        self,
+        data: Union[DeoceanData, bytes],
+        priority: int = PRIORITY_HIGH,
+        key: Union[Hashable, None] = None,
+        ack: bool = False,
+    ) -> Union[asyncio.Future, None]:
+        """同 send(), 给 hass 的协程使用. 不会等待重连"""
+        return self.send(data, priority, key, ack)
 
     def stop_listen(self):
         self._listening = False
-        if self.sock:
-            self.sock.close()
-            self.sock = None
-        if self._thread:
-            self._thread.join()
-
-    def _get_data(self):
-        if self.sock is None:
-            self.open_socket()
-        try:
-            # 设置非阻塞模式，避免卡死
-            self.sock.settimeout(1.0)  # 1秒超时
-            return self.sock.recv(1024)
-        except socket.timeout:
-            return None
-        except ConnectionResetError:
-            self.open_socket()
-            return None
-        except Exception as e:
-            _LOGGER.debug(f"接收数据异常: {e}")
-            return None
+        self.scheduler.stop()
+        self.scheduler.clear()
+        self.acks.cancel_all()
+        if self._connection_task is not None:
+            self._connection_task.cancel()
+            self._connection_task = None
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            self._reconcile_task = None
+        if self._motion_handle is not None:
+            self._motion_handle.cancel()
+            self._motion_handle = None
+        self._moving.clear()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self._set_state(ConnectionState.DISCONNECTED, "stopped")
 
     def add_device(self, device: DeoceanDevice, force: bool = False):
         key = toInt(device.addr.mac_address)
         if key in self.devices and not force:
             return
         self.devices[key] = device
+        self._dispatch[key] = device
+        self.devices_version += 1
+
+    def remove_device(self, addr) -> Union[DeoceanDevice, None]:
+        """移除设备, 编译好的场景会在下一次触发时重新编译"""
+        key = toInt(addr.mac_address if isinstance(addr, DeviceAddr) else addr)
+        device = self.devices.pop(key, None)
+        if device is None:
+            return None
+        del self._dispatch[key]
+        self._moving.pop(key, None)
+        self._dirty.pop(key, None)
+        self._reconciled_at.pop(key, None)
+        self.scheduler.discard((device._target_key, device._sync_key))
+        self.devices_version += 1
+        # 被设备占用的面板地址重新生效
+        prefix = f"{key:08X}:"
+        for id, scene_task in self.scenes.items():
+            if id.startswith(prefix):
+                channel = int(id[len(prefix) :])
+                self._dispatch.setdefault(key, {})[channel] = scene_task
+        return device
 
     def get_device(self, addr):
         if isinstance(addr, DeviceAddr):
@@ -309,6 +1529,89 @@ class DeoceanGateway:
     def list_devices(self, type) -> set:
         return {device for (_, device) in self.devices.items() if device.type == type}
 
+    async def async_sync_all(
+        self, retries: int = 1, max_age: Union[float, None] = None
+    ):
+        """后台同步所有设备的状态.
+
+        所有 sync 帧一次性以低优先级提交, 由调度器合并成几次写入并限速发出, 不会挤占用户操作。
+        每个 sync 都等待网关回复, 没有回复(超时)的设备会重试 retries 次.
+        max_age 不为空时, 只同步状态未知或者超过 max_age 秒没有收到回复的设备(比如从快照恢复的).
+        全部设备都有状态之后记录耗时, 参见 sync_stats().
+        """
+        started = time.monotonic()
+        now = time.time()
+        self._sync_duration = None
+        pending = [
+            dev
+            for dev in self.devices.values()
+            if dev.last_seen is None or max_age is None or now - dev.last_seen > max_age
+        ]
+        _LOGGER.debug(f"需要同步 {len(pending)}/{len(self.devices)} 个设备的状态")
+        for _ in range(retries + 1):
+            with self.batch():
+                futures = [dev.sync(ack=True) for dev in pending]
+            results = await asyncio.gather(
+                *[future for future in futures if future is not None],
+                return_exceptions=True,
+            )
+            if any(isinstance(result, asyncio.CancelledError) for result in results):
+                return  # 网关已停止
+            pending = [
+                dev for dev in pending if dev.last_seen is None or dev.last_seen < now
+            ]
+            if not pending:
+                self._sync_duration = time.monotonic() - started
+                _LOGGER.debug(
+                    f"{len(self.devices)} 个设备状态同步完成, 耗时 {self._sync_duration:.2f}s"
+                )
+                return
+        _LOGGER.warning(
+            f"{len(pending)} 个设备没有回复状态: {', '.join(dev.name for dev in pending)}"
+        )
+
+    def sync_stats(self) -> dict:
+        """状态同步统计, duration 为所有设备都有状态所用的时间(秒), 尚未完成时为 None"""
+        return {
+            "devices": len(self.devices),
+            "unknown": sum(
+                1 for dev in self.devices.values() if dev.switch_status is None
+            ),
+            "duration": self._sync_duration,
+            "reconciled": self.reconcile_sent,
+        }
+
+    def snapshot(self) -> dict:
+        """所有设备最近一次的状态.
+
+        格式为 {地址: [开关状态, 位置, 最近收到回复的时间戳, 窗帘全程时间(灯具为 None)]}
+        """
+        return {
+            f"{addr:08X}": [
+                dev.switch_status,
+                dev.position,
+                dev.last_seen,
+                dev.motion.travel_time if dev.motion is not None else None,
+            ]
+            for addr, dev in self.devices.items()
+            if dev.last_seen is not None
+        }
+
+    def restore(self, snapshot: dict) -> int:
+        """从 snapshot() 的结果恢复设备状态, 不存在的设备跳过, 返回恢复的设备数"""
+        restored = 0
+        for addr, (switch_status, position, last_seen, *extra) in snapshot.items():
+            device = self.get_device(addr)
+            if device is None or device.last_seen is not None:
+                continue  # 设备已删除, 或者已经收到了更新的状态
+            device.switch_status = switch_status
+            device.position = position
+            device.last_seen = last_seen
+            if extra and extra[0] and device.motion is not None:
+                device.motion.travel_time = extra[0]
+            restored += 1
+        return restored
+
 
 #####################################
 ############ 协议相关 ################
@@ -427,6 +1730,9 @@ class DeoceanData(DeoceanStructData):
             v = ControlCode.COVER_SYNC.value
             padding.append(v >> 8)
             padding.append(v & 0xFF)
+        elif self.channel is not None:
+            # 面板按键, 格式为 0xEF channel, 解析见 FrameDecoder
+            padding = [0xEF, self.channel]
         elif self.ctrl_code:
             # 因为Control Code 是2bit，append 俩次是为了计算size的时候正确，否则这里需要手动调用一次 size += 1
             v = self.ctrl_code.value
@@ -476,24 +1782,85 @@ class DeoceanDevice:
         self.type = type
         self.switch_status: Union[str, None] = None
         self.position: Union[int, None] = None  # 窗帘可能有位置.
+        self.last_seen: Union[float, None] = None  # 最近一次收到网关回复的时间戳
+        self.last_command_at: Union[float, None] = None  # 最近一次发出控制指令的时间戳
+        # 窗帘的运动模型, 用于移动过程中的位置插值
+        self.motion = CoverMotion() if self.type == TypeCode.COVER else None
         self.gw.add_device(self)
 
         self.status_callback: List[Callable[..., None]] = []
         self._name = name if name else self.type.name
+        # 发送队列中用于合并同类指令的 key
+        self._target_key = (self.addr.mac_address, CMD_TARGET)
+        self._sync_key = (self.addr.mac_address, CMD_SYNC)
+        # 设备能发的指令就那么几种(开/关/同步/0~100的位置), 编码好的帧直接缓存起来.
+        # key 为操作名(turn_on/turn_off/sync)或者窗帘位置, 值为可以直接写入 socket 的 bytes
+        self._frames: Dict[Union[str, int], bytes] = {
+            "sync": self._ctrl_(FuncCode.SYNC),
+            "turn_on": self._ctrl_(
+                FuncCode.SWITCH,
+                (
+                    ControlCode.COVER_ON
+                    if self.type == TypeCode.COVER
+                    else ControlCode.LIGHT_ON
+                ),
+            ),
+            "turn_off": self._ctrl_(
+                FuncCode.SWITCH,
+                (
+                    ControlCode.LIGHT_OFF
+                    if self.type == TypeCode.LIGHT
+                    else ControlCode.COVER_OFF
+                ),
+            ),
+        }
 
     def _call_status_update(self):
-        batch_action(self.status_callback, self)
+        if self.gw:
+            # 由网关合并之后在事件循环中统一回调
+            self.gw.mark_dirty(self)
+        else:
+            batch_action(self.status_callback, self)
 
-    def send(self, data: DeoceanData) -> None:
+    def send(
+        self,
+        data: Union[DeoceanData, bytes],
+        priority: int = PRIORITY_HIGH,
+        key: Union[Hashable, None] = None,
+        ack: bool = False,
+    ) -> Union[asyncio.Future, None]:
+        if key == self._target_key:
+            # 控制指令, 后台对账会检查之后有没有收到回复
+            self.last_command_at = time.time()
         if self.gw:
-            self.gw.send(data)
+            return self.gw.send(data, priority, key, ack)
+        return None
+
+    def frame(self, op: Union[str, int]) -> bytes:
+        """获取指令对应的原始帧, op 为 turn_on/turn_off/sync 或者窗帘位置(0-100).
+
+        位置帧在第一次使用时才编码, 之后直接复用.
+        """
+        frame = self._frames.get(op)
+        if frame is not None:
+            return frame
+        if not isinstance(op, int) or isinstance(op, bool):
+            raise ValueError(f"不支持的操作:{op}")
+        if self.type != TypeCode.COVER:
+            raise ValueError("仅窗帘支持设置位置")
+        pos = max(min(op, 100), 0)
+        frame = self._frames.get(pos)
+        if frame is None:
+            frame = self._frames[pos] = self._ctrl_(FuncCode.COVER_POSITION, None, pos)
+        return frame
 
     def _ctrl_(
         self,
         func_code: FuncCode,
         ctrl_code: Union[ControlCode, None] = None,
         pos: Union[int, None] = None,
-    ) -> None:
+    ) -> bytes:
+        """把指令编码成帧, 仅在构建指令缓存时调用"""
         payload = DeoceanData(func_code)
         payload.type = self.type
         payload.func_code = func_code
@@ -520,7 +1887,7 @@ class DeoceanDevice:
                 payload.ctrl_code = ctrl_code
             else:
                 raise ValueError(f"不支持的设备类型:{self.type}")
-        return self.send(payload)
+        return payload.encode()
 
     def register_update_callback(self, _callable: Callable) -> bool:
         if callable(_callable):
@@ -544,47 +1911,90 @@ class DeoceanDevice:
             ControlCode.LIGHT_OFF.name,
         ]
 
-    def toggle(self):
+    # 以下指令在 ack 为 True 时返回等待网关回复的 future, 参见 DeoceanGateway.send
+
+    def toggle(self, ack: bool = False):
         """开关切换,在没有状态的情况下首次执行会是开"""
         if self.is_on:
-            self.turn_off()
-        else:
-            self.turn_on()
+            return self.turn_off(ack)
+        return self.turn_on(ack)
 
-    def turn_on(self):
+    def turn_on(self, ack: bool = False):
         """打开设备"""
-        self._ctrl_(
-            FuncCode.SWITCH,
-            (
-                ControlCode.COVER_ON
-                if self.type == TypeCode.COVER
-                else ControlCode.LIGHT_ON
-            ),
-        )
+        return self._command("turn_on", ack)
 
-    def turn_off(self):
+    def turn_off(self, ack: bool = False):
         """关闭设备"""
-        self._ctrl_(
-            FuncCode.SWITCH,
-            (
-                ControlCode.LIGHT_OFF
-                if self.type == TypeCode.LIGHT
-                else ControlCode.COVER_OFF
-            ),
-        )
+        return self._command("turn_off", ack)
 
-    def set_position(self, pos: int):
+    def set_position(self, pos: int, ack: bool = False):
         """设置窗帘位置,hass称100表示完全打开。0是关闭"""
         if self.type != TypeCode.COVER:
             raise ValueError("仅窗帘支持设置位置")
-        self._ctrl_(FuncCode.COVER_POSITION, None, pos)
+        return self._command(int(pos), ack)
+
+    def _command(self, op: Union[str, int], ack: bool = False):
+        """发送控制指令, 窗帘位置已知时开始插值"""
+        frame = self.frame(op)
+        self._begin_motion(op)
+        return self.send(frame, PRIORITY_HIGH, self._target_key, ack)
+
+    def _begin_motion(self, op: Union[str, int]):
+        if self.motion is not None and self.position is not None:
+            if op == "turn_on":
+                target = 100
+            elif op == "turn_off":
+                target = 0
+            else:
+                target = max(min(op, 100), 0)
+            self.motion.start(self.position, target, time.monotonic())
+            if self.motion.moving and self.gw:
+                self.gw.track_motion(self)
+
+    def satisfies(self, op: Union[str, int], now: float, max_age: float) -> bool:
+        """缓存的状态是否已经是 op 的结果. 状态未知/过期/指令还没有回复/窗帘正在移动时返回 False"""
+        if self.last_seen is None or now - self.last_seen > max_age:
+            return False
+        if self.last_command_at is not None and self.last_command_at >= self.last_seen:
+            return False
+        if self.motion is not None:
+            if self.motion.moving:
+                return False
+            if op == "turn_on":
+                op = 100
+            elif op == "turn_off":
+                op = 0
+            if isinstance(op, int) and self.position is not None:
+                return self.position == op
+        if op in ("turn_on", 100):
+            return self.is_on
+        if op in ("turn_off", 0):
+            return self.is_close
+        return False
+
+    @property
+    def current_position(self) -> Union[int, None]:
+        """当前位置, 窗帘移动过程中为插值位置"""
+        if self.motion is not None and self.motion.moving:
+            return self.motion.position(time.monotonic())
+        return self.position
 
-    def sync(self):
+    def sync(self, ack: bool = False):
         """状态同步, 网关搜到消息之后会告知当前灯具/窗帘开关状态"""
-        self._ctrl_(FuncCode.SYNC)
+        # 状态同步属于批量操作, 不能挤占用户操作
+        return self.send(self._frames["sync"], PRIORITY_LOW, self._sync_key, ack)
+
+    async def async_control(self, op: Union[str, int], ack: bool = False):
+        """在事件循环中执行指令, op 同 frame()"""
+        if not self.gw:
+            return None
+        if op == "sync":
+            return self.sync(ack)
+        return self._command(op, ack)
 
     def update(self, **kwargs):
         """更新请使用此接口,方便状态同步"""
+        self.last_seen = time.time()
         dirty = False
         if (pos := kwargs.get("position")) is not None and self.type == TypeCode.COVER:
             dirty = self.position != pos
@@ -607,92 +2017,191 @@ class DeoceanDevice:
             if not dirty:
                 dirty = self.switch_status != switch_status
             self.switch_status = switch_status
+        if self.motion is not None and self.motion.moving and pos is not None:
+            if self.motion.observe(pos, time.monotonic()):
+                # 窗帘还在移动, 中间位置由网关按固定频率插值刷新, 不用每帧都写状态
+                return
         if dirty:
             self._call_status_update()
 
     def __str__(self) -> str:
-        return f"{self.name}<type={self.type.name},addr={self.unique_id},status={self.switch_status}>"
+        return f"{self.name}<type={self.type.name},addr={self.addr.mac_address:08X},status={self.switch_status}>"
 
     @property
     def name(self):
         return self._name
 
+    @name.setter
+    def name(self, name: str):
+        self._name = name
+
     @property
     def unique_id(self):
         """
         See https://www.home-assistant.io/faq/unique_id/
+
+        不同网关下的设备地址可能重复, 所以加上网关的前缀.
         """
-        return f"{self.addr.mac_address:08X}"
+        return f"{self.gw.unique_id}-{self.addr.mac_address:08X}"
 
 
-def parse_data(data):
-    data = copy.copy(data)
-    while data:
-        try:
-            if len(data) < 3:
-                return
-            dev_type = TypeCode(struct.unpack("B", data[:1])[0])
+MAX_FRAME_SIZE = 64
+
+
+class FrameDecoder:
+    """流式解帧器, 每个连接持有一个实例.
+
+    TCP 是流式的, 一次 recv 可能只拿到半个帧, 也可能一次拿到好几个帧。
+    所以这里维护一个重组缓冲区: feed 进去原始字节, 拿出来完整的帧, 不完整的部分留到下一次。
+    解析时只移动偏移量, 不会每处理一个帧就重新切片整个 bytes.
+    遇到无法识别的数据时, 直接搜索下一个合法的帧头(0x7E 或 0x55 0xAA)进行重新同步.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        # 统计信息, reset 不会清零
+        self.frames = 0  # 完整的帧
+        self.dropped = 0  # 帧完整但是无法解析(未知的控制码等)
+        self.resyncs = 0  # 重新同步的次数
+        self.skipped = 0  # 重新同步时跳过的字节数
+
+    def reset(self):
+        """丢弃缓冲区内残留的数据(比如重连之后)"""
+        self._buf.clear()
+
+    @property
+    def pending(self) -> int:
+        """缓冲区中尚未成帧的字节数"""
+        return len(self._buf)
+
+    def feed(self, data: bytes) -> List[DeoceanData]:
+        """喂入数据, 返回其中完整且有意义的帧"""
+        return self._feed(data, False)
+
+    def feed_raw(self, data: bytes) -> List[Tuple[bytes, Union[DeoceanData, None]]]:
+        """同 feed, 但是返回每个完整帧的原始字节以及解析结果(没有意义的帧解析结果为 None).
+
+        用于需要原样转发帧的场景(比如代理).
+        """
+        return self._feed(data, True)
+
+    def _feed(self, data: bytes, keep_raw: bool) -> list:
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        size = len(buf)
+        with memoryview(buf) as view:
+            while size - pos >= 3:
+                frame, frame_size = self._decode_at(buf, view, pos, size)
+                if frame_size == 0:  # 半个帧, 等下一次数据
+                    break
+                if frame_size < 0:  # 不是合法的帧头, 搜索下一个帧头
+                    resync_at = self._next_header(buf, pos + 1, size)
+                    self.resyncs += 1
+                    self.skipped += resync_at - pos
+                    pos = resync_at
+                    continue
+                self.frames += 1
+                if frame is None:
+                    self.dropped += 1
+                if keep_raw:
+                    frames.append((bytes(view[pos : pos + frame_size]), frame))
+                elif frame is not None:
+                    frames.append(frame)
+                pos += frame_size
+        if pos:
+            del buf[:pos]
+        return frames
+
+    @staticmethod
+    def _next_header(buf: bytearray, start: int, size: int) -> int:
+        light = buf.find(0x7E, start)
+        cover = buf.find(0x55, start)
+        if light < 0:
+            return size if cover < 0 else cover
+        if cover < 0:
+            return light
+        return min(light, cover)
+
+    @staticmethod
+    def _decode_at(buf: bytearray, view: memoryview, pos: int, size: int):
+        """在 pos 处尝试解析一个帧.
+
+        返回 (frame, frame_size):
+            frame_size == 0    数据不完整
+            frame_size < 0     非法帧头, 需要重新同步
+            frame_size > 0     完整的帧(frame 可能为 None, 表示帧完整但没有意义, 直接跳过)
+        """
+        head = buf[pos]
+        if head == TypeCode.LIGHT.value:
+            dev_type = TypeCode.LIGHT
             start_at = 2
+            msg_size = buf[pos + 1]
+        elif head == TypeCode.COVER.value:
+            if buf[pos + 1] != 0xAA:
+                return None, -1
+            dev_type = TypeCode.COVER
+            start_at = 3  # 多一个占位符AA.
+            msg_size = buf[pos + 2] - 1  # 但整体长度这里要少一位😂，有毒吧
+        else:
+            return None, -1
+        if msg_size < 1 or msg_size > MAX_FRAME_SIZE:
+            return None, -1
+        # 起始点包括header 1～2字节。消息体 size字节 + 结束符一字节.
+        frame_size = start_at + msg_size + 1
+        if size - pos < frame_size:
+            return None, 0
+        # 消息体为 [begin, end], end 即结束符所在位置
+        begin = pos + start_at
+        end = pos + frame_size - 1
+        if buf[end] != STOP_BIT:
+            return None, -1
+        try:
+            func_code = FuncCode(buf[begin])
+        except ValueError:
+            return None, -1
+        msg_len = frame_size - start_at
+        payload = DeoceanData(func_code)
+        addr = None
+        if func_code != FuncCode.SEARCH:
+            if msg_len < 5:
+                return None, frame_size
+            addr = int.from_bytes(view[begin + 1 : begin + 5], "big")
+            if addr == 0:
+                return None, frame_size
+            addr = DeviceAddr(addr)
+        payload.type = dev_type
+        payload.device_address = addr
+        ctrl_code_num = None
+        if msg_len > 6:  # 4 字节地址 + 2 字节功能 + 1 字节结束符0x0D
             if dev_type == TypeCode.LIGHT:
-                msg_size = struct.unpack("B", data[1:2])[0]
-            elif dev_type == TypeCode.COVER:
-                placeholder, msg_size = struct.unpack("BB", data[1:3])
-                if placeholder != 0xAA:
-                    data = data[3:]
-                    continue
-                start_at += 1  # 多一个占位符AA.
-                msg_size -= 1  # 但整体长度这里要少一位😂，有毒吧
-            # 起始点包括header 1～2字节。消息体 size字节 + 结束符一字节.
-            frame_size = start_at + msg_size + 1
-            if len(data) < frame_size:
-                return data
-            frame = data[start_at:frame_size]
-            msg = struct.unpack("B" * len(frame), frame)
-            if msg[-1] != STOP_BIT:
-                data = data[frame_size:]
-                continue
-            payload = DeoceanData(FuncCode(msg[0]))
-            addr = None
-            if payload.func_code != FuncCode.SEARCH:
-                if len(msg) < 5:
-                    data = data[frame_size:]
-                    continue
-                addr = toInt(msg[1:5])
-                if addr == 0:
-                    data = data[frame_size:]
-                    continue
-                addr = DeviceAddr(addr)
-            payload.type = dev_type
-            payload.device_address = addr
-            ctrl_code_num = None
-            if len(msg) > 6:  # 4 字节地址 + 2 字节功能 + 1 字节结束符0x0D
-                if dev_type == TypeCode.LIGHT:
-                    # 场景值功能区域似乎都是0xEFxx形式。所以后三位一定是0xEFxx0D, xx是channel.
-                    if msg[-3] == 0xEF:
-                        payload.channel = msg[-2]
-                    else:
-                        # 就是普通灯具.提取功能码
-                        ctrl_code_num = (msg[-3] << 8) + msg[-2]
-                elif msg[-2] != 0xFF:  # 窗帘有时候返回的0xFF不知道什么意思
-                    payload.position = (
-                        msg[-2]
-                        if payload.func_code
-                        not in [FuncCode.SWITCH_UPDATED, FuncCode.SWITCH]
-                        else None
-                    )
-                    # 窗帘位置设置之后为0x02, 位置是没有控制码的.
-                    if msg[-4] == 0x01 and payload.func_code != FuncCode.SYNC:
-                        ctrl_code_num = (msg[-3] << 8) + msg[-2]
+                # 场景值功能区域似乎都是0xEFxx形式。所以后三位一定是0xEFxx0D, xx是channel.
+                if buf[end - 2] == 0xEF:
+                    payload.channel = buf[end - 1]
+                else:
+                    # 就是普通灯具.提取功能码
+                    ctrl_code_num = (buf[end - 2] << 8) + buf[end - 1]
+            elif buf[end - 1] != 0xFF:  # 窗帘有时候返回的0xFF不知道什么意思
+                if func_code not in (FuncCode.SWITCH_UPDATED, FuncCode.SWITCH):
+                    payload.position = buf[end - 1]
+                # 窗帘位置设置之后为0x02, 位置是没有控制码的.
+                if buf[end - 3] == 0x01 and func_code != FuncCode.SYNC:
+                    ctrl_code_num = (buf[end - 2] << 8) + buf[end - 1]
+        if ctrl_code_num is not None:
             try:
-                if ctrl_code_num is not None:
-                    payload.ctrl_code = ControlCode(ctrl_code_num)
-                yield payload
+                payload.ctrl_code = ControlCode(ctrl_code_num)
             except ValueError:
-                pass
-            data = data[frame_size:]  # 等待新消息
-        except Exception as e:
-            data = data[1:]  # 往前迁移一字节处理.
-            continue
+                return None, frame_size
+        return payload, frame_size
+
+
+def parse_data(data):
+    """一次性解析一段完整的数据, 末尾不完整的帧会被丢弃.
+
+    处理 socket 这种流式数据请使用 FrameDecoder, 它会保留不完整的帧等待后续数据.
+    """
+    yield from FrameDecoder().feed(data)
 
 
 def split_txt_to_lines(txt: str, sep: str = ",", field_cnt: Union[int, None] = None):
@@ -706,6 +2215,7 @@ def split_txt_to_lines(txt: str, sep: str = ",", field_cnt: Union[int, None] = N
             if len(fields) < field_cnt:
                 continue
             yield fields[:field_cnt]
+            continue
         yield fields
 
 
@@ -731,6 +2241,152 @@ def parse_scene_str(txt: str):
         yield Scene(fields[0], int(fields[1], 16), int(fields[2]), tasks)
 
 
+class ScenePlan:
+    """编译好的场景执行计划.
+
+    注册场景时把设备名解析成设备, 固定的操作(turn_on/turn_off/sync/窗帘位置)直接取设备缓存的帧,
+    拼接成一个 buffer. 触发时只需要补上 toggle 的帧(依赖当前状态), 然后一次提交给调度器.
+    网关的设备有增删时(devices_version 变化), 下一次触发前自动重新编译.
+    """
+
+    # 特殊设备名
+    GROUPS = ("all", "all_light", "all_cover")
+
+    def __init__(self, gw: DeoceanGateway, scene: Scene):
+        self.gw = gw
+        self.scene = scene
+        self.version = -1
+        self.fixed = b""  # 固定操作拼接好的帧
+        self.fixed_count = 0
+        self.toggles: List[DeoceanDevice] = []
+        self.members: List[DeoceanDevice] = []  # 收到控制指令的设备
+        self.keys: List[Hashable] = []  # 所有控制指令(包括 toggle)在发送队列中的 key
+        self.moves: List[Tuple[DeoceanDevice, Union[str, int]]] = []  # 需要插值的窗帘
+        # 按状态差异执行时使用: 固定的控制指令 (设备, 操作, 帧), 以及 sync 的帧
+        self.targets: List[Tuple[DeoceanDevice, Union[str, int], bytes]] = []
+        self.syncs = b""
+        self.sync_count = 0
+
+    def resolve(self) -> Dict[DeoceanDevice, Union[str, int]]:
+        """设备 -> 操作, 同一个设备出现多次时以最后一次为准, 不支持的操作直接忽略"""
+        by_name = {dev.name: dev for dev in self.gw.devices.values()}
+        ops: Dict[DeoceanDevice, Union[str, int]] = {}
+        for dev_name, op in self.scene.tasks:
+            if dev_name in self.GROUPS:
+                devices = [
+                    dev
+                    for dev in self.gw.devices.values()
+                    if dev_name == "all"
+                    or (dev_name == "all_light") == (dev.type == TypeCode.LIGHT)
+                ]
+            elif dev_name in by_name:
+                devices = [by_name[dev_name]]
+            else:
+                continue
+            for dev in devices:
+                if op in ("turn_on", "turn_off", "toggle", "sync"):
+                    ops[dev] = op
+                elif dev.type == TypeCode.COVER:
+                    try:
+                        ops[dev] = max(min(int(op), 100), 0)
+                    except ValueError:
+                        continue
+        return ops
+
+    def compile(self):
+        fixed, toggles, members, moves, targets, syncs = [], [], [], [], [], []
+        for dev, op in self.resolve().items():
+            if op == "toggle":
+                toggles.append(dev)
+                continue
+            frame = dev.frame(op)
+            fixed.append(frame)
+            if op == "sync":
+                syncs.append(frame)
+                continue
+            targets.append((dev, op, frame))
+            members.append(dev)
+            if dev.motion is not None:
+                moves.append((dev, op))
+        self.fixed = b"".join(fixed)
+        self.fixed_count = len(fixed)
+        self.toggles = toggles
+        self.members = members
+        self.keys = [dev._target_key for dev in members + toggles]
+        self.moves = moves
+        self.targets = targets
+        self.syncs = b"".join(syncs)
+        self.sync_count = len(syncs)
+        self.version = self.gw.devices_version
+
+    def __len__(self):
+        return self.fixed_count + len(self.toggles)
+
+    def toggle_op(self) -> str:
+        """场景的 toggle 按整组计算: 只要有一个设备是开的就全部关闭, 否则全部打开.
+
+        每个设备各自 toggle 的话, 设备状态不一致(或者上一次的回复还没到)时会越按越乱.
+        """
+        for dev in self.toggles:
+            if dev.is_on:
+                return "turn_off"
+        return "turn_on"
+
+    def __call__(self):
+        if self.version != self.gw.devices_version:
+            self.compile()
+        if self.gw.scene_diff:
+            self._execute_diff()
+            return
+        data, count = self.fixed, self.fixed_count
+        if self.toggles:
+            op = self.toggle_op()
+            data += b"".join(dev.frame(op) for dev in self.toggles)
+            count += len(self.toggles)
+            for dev in self.toggles:
+                dev._begin_motion(op)
+        if not count:
+            return
+        now = time.time()
+        for dev in self.members:
+            dev.last_command_at = now
+        for dev in self.toggles:
+            dev.last_command_at = now
+        for dev, op in self.moves:
+            dev._begin_motion(op)
+        self.gw.send_buffer(data, count, keys=self.keys)
+
+    def _execute_diff(self):
+        """只给状态和目标不一致的设备发指令. 状态未知/过期/还有指令在路上的设备照常发送"""
+        now = time.time()
+        max_age = self.gw.scene_diff_max_age
+        sends = [
+            (dev, op, frame)
+            for dev, op, frame in self.targets
+            if not dev.satisfies(op, now, max_age)
+        ]
+        if self.toggles:
+            op = self.toggle_op()
+            sends.extend(
+                (dev, op, dev.frame(op))
+                for dev in self.toggles
+                if not dev.satisfies(op, now, max_age)
+            )
+        self.gw.scene_frames_skipped += (
+            len(self.targets) + len(self.toggles) - len(sends)
+        )
+        if not sends and not self.sync_count:
+            return
+        for dev, op, _ in sends:
+            dev.last_command_at = now
+            dev._begin_motion(op)
+        self.gw.send_buffer(
+            self.syncs + b"".join(frame for _, _, frame in sends),
+            self.sync_count + len(sends),
+            keys=[dev._target_key for dev, _, _ in sends],
+        )
+
+
 def register_scenes(hub: DeoceanGateway, raw_txt: str):
     """
     工具函数. 注册场景.
@@ -752,62 +2408,36 @@ def register_scenes(hub: DeoceanGateway, raw_txt: str):
         如你所见，在同一个场景下把A设备打开,B设备关闭,C设备toggle的状态。
     但如果需要这么做,我们可以扩展格式:
     '
-    # 所有灯具先turn_off关闭。然后窗帘没有指定则用默认值 turn_on, 过道灯虽然也在all_light中被先关闭了，此处你可以再toggle一次。
-    # 实际情况下，可能因为 前面all_light灯具状态没有返回就已经执行toggle了，所以可能会出现toggle状态弄错的问题
+    # 所有灯具turn_off关闭。然后窗帘没有指定则用默认值 turn_on, 过道灯虽然也在all_light中, 但同一个设备以最后一次出现的操作为准, 所以过道灯是toggle。
+    # 同一个场景里所有 toggle 的设备按整组处理: 只要有一个是开的就全部关闭, 否则全部打开, 不会出现有开有关的情况
     #
     回家, 0x0A0B0C0D, 2, all_light:turn_off|客厅布帘|过道灯:toggle, turn_on
     '
     """
-    all_lights = hub.list_devices(TypeCode.LIGHT)
-    all_cover = hub.list_devices(TypeCode.COVER)
+    for scene in parse_scene_str(raw_txt):
+        # 编译成执行计划, 触发时直接发送编码好的帧
+        plan = ScenePlan(hub, scene)
+        plan.compile()
+        if not len(plan):
+            continue
 
-    devices_map = {dev.name: dev for dev in hub.devices.values()}
+        hub.register_scene(scene.addr, scene.channel, plan, scene.name, True)
 
-    def operation_wrapper(dev: DeoceanDevice, op: str):
-        """
-        把场景的op转成设备可以支持的指令
-        """
-        if op in ["turn_on", "turn_off", "toggle", "sync"]:
-            return getattr(dev, op)
-        if dev.type != TypeCode.COVER:
-            return
-        try:
-            op = max(min(int(op), 100), 0)
-        except:
-            return
-        return partial(dev.set_position, op)
 
-    for scene in parse_scene_str(raw_txt):
-        # 集合以去重
-        callback = set()
-        for dev_name, op in scene.tasks:
-            if dev_name in ["all_light", "all_cover", "all"]:
-                if dev_name != "all_cover":
-                    callback.update({operation_wrapper(dev, op) for dev in all_lights})
-                if dev_name != "all_light":
-                    callback.update({operation_wrapper(dev, op) for dev in all_cover})
-            elif dev_name in devices_map:
-                callback.add(operation_wrapper(devices_map.get(dev_name), op))
-        # 过滤掉所有不支持的回调
-        callback = {cb for cb in callback if cb is not None}
-        if (size := len(callback)) == 0:
+def parse_device_str(txt: str):
+    """解析设备配置, 格式为: name, type(light|blind), addr. 不支持的类型直接忽略"""
+    for name, typ, addr in split_txt_to_lines(txt, ",", 3):
+        if typ not in ["light", "blind"]:
             continue
-
-        hub.register_scene(
-            scene.addr, scene.channel, partial(batch_action, callback), scene.name, True
-        )
+        yield name, TypeCode.COVER if typ == "blind" else TypeCode.LIGHT, addr
 
 
 def register_devices(hub: DeoceanGateway, raw_txt: str):
     """工具函数,注册给定的设备到网关"""
-    for name, typ, addr in split_txt_to_lines(raw_txt, ",", 3):
-        if typ not in ["light", "blind"]:
-            continue
-        dev = DeoceanDevice(
-            hub, addr, TypeCode.COVER if typ == "blind" else TypeCode.LIGHT, name
-        )
+    for name, typ, addr in parse_device_str(raw_txt):
+        dev = DeoceanDevice(hub, addr, typ, name)
         hub.add_device(dev)  # 加入当前设备
-        dev.sync()  # 网关有此设备后同步一次状态
+    # 注册完之后需要调用 hub.async_sync_all() 在后台同步一次状态
 
 
 ######## 测试方法 #####
@@ -863,9 +2493,7 @@ def test_decode():
     # grep -E 'Set(Position|Switch)' ebelong.log | cut -d : -f7-8
     sendCmdText = """
     data: 55 AA 09 0D 74 C1 5D 78 01 04 61 0D
-    """.split(
-        "\n"
-    )
+    """.split("\n")
 
     no = 0
     for line in sendCmdText:
@@ -883,11 +2511,10 @@ def test_decode():
             print("\t", frame)
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+async def main():
     gw = DeoceanGateway("192.168.5.201", 50016)
 
-    gw.start_listen()
+    await gw.async_start_listen()
 
     test_light(gw)
 
@@ -896,3 +2523,14 @@ if __name__ == "__main__":
     test_scene(gw)
 
     test_decode()
+
+    await gw.async_sync_all()
+
+    # 等待网关的回复
+    await asyncio.sleep(3)
+    gw.stop_listen()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(main())
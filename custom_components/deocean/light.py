@@ -2,10 +2,11 @@
 
 from homeassistant.components.light import LightEntity, ColorMode
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DOMAIN, VERSION
+from .const import DOMAIN, SIGNAL_DEVICES_ADDED, VERSION
 from .hub import DeoceanDevice, DeoceanGateway, TypeCode
 
 
@@ -15,6 +16,19 @@ async def async_setup_entry(
     hub: DeoceanGateway = hass.data[DOMAIN][entry.entry_id]
     lights = hub.list_devices(TypeCode.LIGHT)
     async_add_entities([DeoceanLight(light) for light in lights])
+
+    @callback
+    def _async_add_lights(devices: list[DeoceanDevice]):
+        """配置修改之后新增的灯具"""
+        async_add_entities(
+            [DeoceanLight(dev) for dev in devices if dev.type == TypeCode.LIGHT]
+        )
+
+    entry.async_on_unload(
+        async_dispatcher_connect(
+            hass, SIGNAL_DEVICES_ADDED.format(entry.entry_id), _async_add_lights
+        )
+    )
     return True
 
 
@@ -27,7 +41,11 @@ class DeoceanLight(LightEntity):
         self.should_poll = False
 
     async def async_added_to_hass(self) -> None:
-        self.dev.register_update_callback(self.schedule_update_ha_state)
+        self.dev.register_update_callback(self._on_device_update)
+
+    def _on_device_update(self, device):
+        """设备状态更新回调, 网关在事件循环中合并之后回调, 每轮最多写一次状态"""
+        self.async_write_ha_state()
 
     @property
     def name(self):
@@ -41,7 +59,7 @@ class DeoceanLight(LightEntity):
     def device_info(self):
         """返回设备信息 - 所有灯具都属于同一个网关设备"""
         return {
-            "identifiers": {(DOMAIN, f"gateway_{self.dev.gw.ip_addr}")},
+            "identifiers": {(DOMAIN, f"gateway_{self.dev.gw.unique_id}")},
             "name": f"德能森网关 ({self.dev.gw.ip_addr})",
             "manufacturer": "德能森",
             "model": "智能网关",
@@ -59,7 +77,10 @@ class DeoceanLight(LightEntity):
         return ColorMode.ONOFF
 
     @property
-    def is_on(self) -> bool:
+    def is_on(self) -> bool | None:
+        """还没有收到网关回复时状态未知"""
+        if self.dev.switch_status is None:
+            return None
         return self.dev.is_on
 
     @property
@@ -68,8 +89,8 @@ class DeoceanLight(LightEntity):
 
     async def async_turn_on(self, **kwargs) -> None:
         """异步打开灯具"""
-        await self.hass.async_add_executor_job(self.dev.turn_on)
+        await self.dev.async_control("turn_on")
 
     async def async_turn_off(self, **kwargs) -> None:
         """异步关闭灯具"""
-        await self.hass.async_add_executor_job(self.dev.turn_off)
+        await self.dev.async_control("turn_off")
@@ -8,15 +8,15 @@
 import socket
 import threading
 import logging
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 from hub import (
     DeoceanData,
     FuncCode,
     ControlCode,
     TypeCode,
     DeviceAddr,
+    FrameDecoder,
     toInt,
-    parse_data,
     split_txt_to_lines,
 )
 from const import DEFAULT_DEVICES
@@ -42,21 +42,27 @@ class MockDevice:
 class MockDeoceanServer:
     """简化的德能森网关模拟服务器"""
 
-    def __init__(self, host="localhost", port=9999):
+    def __init__(self, host="localhost", port=9999, devices: str = DEFAULT_DEVICES):
         self.host = host
+        # port 为 0 时由系统分配, start 之后可以从 self.port 读到实际端口
         self.port = port
         self.server_socket = None
         self.running = False
+        self.started = threading.Event()
         self.clients = []
         self.devices: Dict[int, MockDevice] = {}
+        # 收到每一帧时的回调(在客户端线程中调用), 压测脚本用它记录设备指令到达的时间
+        self.frame_listener: Optional[Callable[[DeoceanData], None]] = None
+        # 按键注入和回复可能来自不同线程, 加锁避免俩个帧交错
+        self._send_lock = threading.Lock()
 
-        # 直接从 const.py 加载设备配置
-        self._load_devices_from_const()
+        # 默认从 const.py 加载设备配置
+        self._load_devices(devices)
         logger.info(f"Mock服务器初始化完成，加载了 {len(self.devices)} 个设备")
 
-    def _load_devices_from_const(self):
-        """从 const.py 的 DEFAULT_DEVICES 加载设备配置"""
-        for name, typ, addr in split_txt_to_lines(DEFAULT_DEVICES, ",", 3):
+    def _load_devices(self, raw_txt: str):
+        """加载设备配置, 格式同 const.py 的 DEFAULT_DEVICES"""
+        for name, typ, addr in split_txt_to_lines(raw_txt, ",", 3):
             try:
                 device_type = (
                     TypeCode.LIGHT if typ.lower() == "light" else TypeCode.COVER
@@ -73,13 +79,17 @@ class MockDeoceanServer:
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        self.port = self.server_socket.getsockname()[1]
         self.running = True
+        self.started.set()
 
         logger.info(f"🚀 Mock服务器启动: {self.host}:{self.port}")
 
         while self.running:
             try:
                 client_socket, addr = self.server_socket.accept()
+                # 关闭 Nagle, 否则连续的小帧会被攒到对端的延迟 ACK 之后才发出
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 logger.info(f"📱 客户端连接: {addr}")
                 threading.Thread(
                     target=self.handle_client, args=(client_socket, addr), daemon=True
@@ -101,6 +111,7 @@ class MockDeoceanServer:
 
     def handle_client(self, client_socket, addr):
         """处理客户端连接"""
+        decoder = FrameDecoder()
         try:
             client_socket.settimeout(1.0)  # 设置超时避免阻塞
             while self.running:
@@ -109,15 +120,19 @@ class MockDeoceanServer:
                     if not data:
                         break
 
-                    for frame in parse_data(data):
+                    for frame in decoder.feed(data):
+                        if self.frame_listener is not None:
+                            self.frame_listener(frame)
                         response = self.process_frame(frame)
                         if response:
-                            client_socket.send(response)
+                            with self._send_lock:
+                                client_socket.sendall(response)
                 except socket.timeout:
                     continue  # 超时继续循环
 
         except Exception as e:
-            logger.error(f"客户端 {addr} 错误: {e}")
+            if self.running:
+                logger.error(f"客户端 {addr} 错误: {e}")
         finally:
             try:
                 client_socket.close()
@@ -127,6 +142,23 @@ class MockDeoceanServer:
                 pass
             logger.info(f"📱 客户端 {addr} 断开")
 
+    def press(self, panel_addr: int, channel: int) -> int:
+        """模拟按下面板按键, 发给所有已连接的客户端, 返回发送的客户端数"""
+        frame = DeoceanData(FuncCode.SWITCH_UPDATED)
+        frame.type = TypeCode.LIGHT
+        frame.device_address = DeviceAddr(panel_addr)
+        frame.channel = channel
+        data = frame.encode()
+        sent = 0
+        with self._send_lock:
+            for client in list(self.clients):
+                try:
+                    client.sendall(data)
+                    sent += 1
+                except OSError as e:
+                    logger.error(f"按键发送失败: {e}")
+        return sent
+
     def process_frame(self, frame: DeoceanData) -> Optional[bytes]:
         """处理帧并生成响应"""
         if not frame.device_address:
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+德能森网关连接复用代理
+
+网关只接受一个客户端连接, 停掉德能森的服务之后, 调试工具/第二个 hass 都连不上了。
+这个代理持有唯一的一条上游连接, 同时接受任意多个下游客户端:
+    - 下游发来的数据按帧切分, 每个客户端一个队列, 轮询(公平排队)转发给网关, 不会出现半个帧交错
+    - 网关发来的帧完整地广播给每一个客户端. 客户端读得太慢(写缓冲超过 max_client_buffer)时
+      跳过发给它的数据(按整块丢弃, 不会出现半个帧), 不会拖垮代理的内存
+    - 上游断开后按指数退避自动重连, 下游客户端不受影响
+
+用法(在 hub.py 所在目录执行):
+    python3 proxy.py --upstream 192.168.5.201:50016 --listen 0.0.0.0:50016
+
+然后把 hass/调试工具的网关地址指向代理即可. 配合 mock_deocean_server.py 测试:
+    python3 mock_deocean_server.py
+    python3 proxy.py --upstream 127.0.0.1:9999 --listen 127.0.0.1:50016
+
+自检(自动启动 mock 网关, 检查转发以及慢客户端的处理, 失败时退出码非 0):
+    python3 proxy.py --self-test
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import sys
+import threading
+from collections import deque
+from typing import Deque, Set, Tuple, Union
+
+from hub import FrameDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyClient(asyncio.Protocol):
+    """一个下游客户端"""
+
+    def __init__(self, proxy: "DeoceanProxy"):
+        self.proxy = proxy
+        self.transport: Union[asyncio.Transport, None] = None
+        self.peer = None
+        self.decoder = FrameDecoder()
+        # 等待转发给网关的帧
+        self.queue: Deque[bytes] = deque()
+        self.dropped = 0
+        # 写缓冲超过上限时为 True, 期间广播的帧直接丢弃
+        self.paused = False
+        self.dropped_down = 0
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+        transport.set_write_buffer_limits(high=self.proxy.max_client_buffer)
+        self.proxy.clients.add(self)
+        logger.info(f"📱 客户端连接: {self.peer}, 当前 {len(self.proxy.clients)} 个")
+
+    def data_received(self, data: bytes):
+        for raw, _ in self.decoder.feed_raw(data):
+            if len(self.queue) >= self.proxy.max_client_queue:
+                # 单个客户端刷屏时只丢它自己的帧, 不影响其他客户端
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(raw)
+        if self.queue:
+            self.proxy.schedule_flush()
+
+    def pause_writing(self):
+        self.paused = True
+        logger.warning(f"客户端 {self.peer} 读得太慢, 暂停向它广播")
+
+    def resume_writing(self):
+        self.paused = False
+        logger.info(f"客户端 {self.peer} 恢复广播, 期间丢弃了 {self.dropped_down} 个帧")
+
+    def connection_lost(self, exc):
+        self.proxy.clients.discard(self)
+        logger.info(f"📱 客户端 {self.peer} 断开")
+
+
+class UpstreamProtocol(asyncio.Protocol):
+    """到网关的上游连接"""
+
+    def __init__(self, proxy: "DeoceanProxy"):
+        self.proxy = proxy
+
+    def data_received(self, data: bytes):
+        self.proxy.broadcast(data)
+
+    def connection_lost(self, exc):
+        self.proxy.upstream_lost(exc)
+
+
+class DeoceanProxy:
+    def __init__(
+        self,
+        upstream: Tuple[str, int],
+        listen: Tuple[str, int] = ("0.0.0.0", 50016),
+        max_client_queue: int = 256,
+        max_frames_per_flush: int = 64,
+        max_client_buffer: int = 64 * 1024,
+    ):
+        self.upstream = upstream
+        self.listen = listen
+        self.max_client_queue = max_client_queue
+        # 每个客户端最多积压的待发送字节数, 超过后暂停向它广播
+        self.max_client_buffer = max_client_buffer
+        # 单次转发的最大帧数, 超过后让出事件循环, 避免饿死其他回调
+        self.max_frames_per_flush = max_frames_per_flush
+        self.clients: Set[ProxyClient] = set()
+        self._server: Union[asyncio.AbstractServer, None] = None
+        self._upstream: Union[asyncio.Transport, None] = None
+        self._upstream_task: Union[asyncio.Task, None] = None
+        self._lost = asyncio.Event()
+        self._decoder = FrameDecoder()
+        self._flush_scheduled = False
+        # 轮询的起点, 保证每个客户端轮流排在第一个
+        self._rr = 0
+        # 统计信息
+        self.frames_up = 0
+        self.frames_down = 0
+        self.reconnects = 0
+
+    async def async_start(self):
+        loop = asyncio.get_running_loop()
+        await self._async_connect_upstream()
+        self._upstream_task = loop.create_task(self._async_maintain_upstream())
+        self._server = await loop.create_server(
+            lambda: ProxyClient(self), self.listen[0], self.listen[1]
+        )
+        # 端口为 0 时由系统分配
+        self.listen = (self.listen[0], self._server.sockets[0].getsockname()[1])
+        logger.info(
+            f"🚀 代理启动: {self.listen[0]}:{self.listen[1]} -> "
+            f"{self.upstream[0]}:{self.upstream[1]}"
+        )
+
+    async def async_stop(self):
+        if self._upstream_task is not None:
+            self._upstream_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for client in list(self.clients):
+            client.transport.close()
+        if self._upstream is not None:
+            self._upstream.close()
+
+    async def _async_connect_upstream(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_connection(
+            lambda: UpstreamProtocol(self), self.upstream[0], self.upstream[1]
+        )
+        self._decoder.reset()
+        self._upstream = transport
+        self._lost.clear()
+        logger.info(f"已连接网关 {self.upstream[0]}:{self.upstream[1]}")
+        # 断线期间积压的帧
+        self.schedule_flush()
+
+    async def _async_maintain_upstream(self):
+        attempt = 0
+        while True:
+            await self._lost.wait()
+            delay = min(60.0, 2**attempt) / 2
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            try:
+                await self._async_connect_upstream()
+            except OSError as e:
+                attempt += 1
+                logger.warning(f"重连网关失败(第{attempt}次): {e}")
+            else:
+                attempt = 0
+                self.reconnects += 1
+
+    def upstream_lost(self, exc):
+        logger.warning(f"网关连接断开: {exc}")
+        self._upstream = None
+        self._lost.set()
+
+    def schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        """轮询每个客户端的队列, 每轮每个客户端一帧, 合并成一次写入"""
+        self._flush_scheduled = False
+        if self._upstream is None:
+            return
+        clients = [client for client in self.clients if client.queue]
+        if not clients:
+            return
+        self._rr = (self._rr + 1) % len(clients)
+        clients = clients[self._rr :] + clients[: self._rr]
+        chunk = []
+        while clients and len(chunk) < self.max_frames_per_flush:
+            for client in clients:
+                chunk.append(client.queue.popleft())
+            clients = [client for client in clients if client.queue]
+        self.frames_up += len(chunk)
+        self._upstream.write(b"".join(chunk))
+        if clients:
+            self.schedule_flush()
+
+    def broadcast(self, data: bytes):
+        """网关的数据按帧切分之后广播给所有客户端, 客户端中途连接也不会收到半个帧"""
+        frames = self._decoder.feed_raw(data)
+        if not frames:
+            return
+        self.frames_down += len(frames)
+        payload = b"".join(raw for raw, _ in frames)
+        for client in self.clients:
+            if client.paused:
+                client.dropped_down += len(frames)
+                continue
+            client.transport.write(payload)
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "upstream_connected": self._upstream is not None,
+            "frames_up": self.frames_up,
+            "frames_down": self.frames_down,
+            "dropped": sum(client.dropped for client in self.clients),
+            "dropped_down": sum(client.dropped_down for client in self.clients),
+            "paused_clients": sum(1 for client in self.clients if client.paused),
+            "reconnects": self.reconnects,
+        }
+
+
+def _addr(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+async def main(args):
+    proxy = DeoceanProxy(_addr(args.upstream), _addr(args.listen))
+    await proxy.async_start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f"统计: {proxy.stats()}")
+    finally:
+        await proxy.async_stop()
+
+
+async def self_test() -> bool:
+    """用 mock 网关检查: 帧能经过代理往返, 不读数据的客户端不会让代理的缓冲无限增长"""
+    from hub import DeoceanData, DeviceAddr, FuncCode
+    from mock_deocean_server import MockDeoceanServer
+
+    server = MockDeoceanServer("127.0.0.1", 0)
+    threading.Thread(target=server.start, daemon=True).start()
+    server.started.wait(5)
+    proxy = DeoceanProxy(
+        ("127.0.0.1", server.port), ("127.0.0.1", 0), max_client_buffer=4096
+    )
+    await proxy.async_start()
+    ok = True
+    try:
+        # 1. 查询一个设备的状态, 回复经过代理回来
+        device = next(iter(server.devices.values()))
+        query = DeoceanData(FuncCode.SYNC)
+        query.type = device.type
+        query.device_address = DeviceAddr(device.addr)
+        reader, writer = await asyncio.open_connection(*proxy.listen)
+        writer.write(query.encode())
+        decoder = FrameDecoder()
+        frames = []
+        while not frames:
+            frames = decoder.feed(await asyncio.wait_for(reader.read(1024), 5))
+        replied = frames[0].device_address.mac_address == device.addr
+        logger.info(f"转发往返: {'通过' if replied else '失败'}")
+        ok &= replied
+
+        # 2. 一个从不读取的客户端, 同时另一个客户端正常读取
+        _, stalled = await asyncio.open_connection(*proxy.listen)
+        # 缩小接收缓冲, 让内核尽快塞满, 不用灌几十 MB 数据
+        stalled.get_extra_info("socket").setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, 4096
+        )
+        while len(proxy.clients) < 2:
+            await asyncio.sleep(0.01)
+        slow = next(
+            client
+            for client in proxy.clients
+            if client.peer == stalled.get_extra_info("sockname")
+        )
+        chunk = query.encode() * 512
+        received = 0
+
+        async def _drain():
+            nonlocal received
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                received += len(data)
+
+        drain = asyncio.create_task(_drain())
+        rounds = 1024
+        peak = 0
+        for _ in range(rounds):
+            proxy.broadcast(chunk)
+            peak = max(peak, slow.transport.get_write_buffer_size())
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.5)
+        drain.cancel()
+        bounded = peak <= proxy.max_client_buffer + len(chunk)
+        logger.info(
+            f"慢客户端: 丢弃 {slow.dropped_down} 帧, 写缓冲峰值 {peak} 字节; "
+            f"正常客户端收到 {received}/{rounds * len(chunk)} 字节"
+        )
+        ok &= bounded and slow.dropped_down > 0 and received == rounds * len(chunk)
+        stalled.close()
+        writer.close()
+    finally:
+        await proxy.async_stop()
+        server.stop()
+    logger.info("自检通过" if ok else "自检失败")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="德能森网关连接复用代理")
+    parser.add_argument("--upstream", help="网关地址, 如 192.168.5.201:50016")
+    parser.add_argument("--listen", default="0.0.0.0:50016", help="代理监听地址")
+    parser.add_argument(
+        "--self-test", action="store_true", help="用 mock 网关自检之后退出"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.self_test:
+        sys.exit(0 if asyncio.run(self_test()) else 1)
+    if not args.upstream:
+        parser.error("需要指定 --upstream")
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("All done!")
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""网关的运行指标, 作为诊断传感器挂在网关设备下面"""
+
+from datetime import timedelta
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import EntityCategory, UnitOfInformation, UnitOfTime
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+from .const import DOMAIN, VERSION
+from .hub import DeoceanGateway
+
+# 指标都在内存里, 读取很便宜, 定时刷新即可. 没有 update 方法, 轮询时在事件循环中直接写状态
+SCAN_INTERVAL = timedelta(seconds=30)
+
+# 指标名(DeoceanGateway.metrics 的 key), 显示名称, 单位, 状态类型
+METRICS = [
+    ("frames_received", "收到帧数", None, SensorStateClass.TOTAL_INCREASING),
+    ("frames_sent", "发送帧数", None, SensorStateClass.TOTAL_INCREASING),
+    (
+        "bytes_received",
+        "收到字节数",
+        UnitOfInformation.BYTES,
+        SensorStateClass.TOTAL_INCREASING,
+    ),
+    (
+        "bytes_sent",
+        "发送字节数",
+        UnitOfInformation.BYTES,
+        SensorStateClass.TOTAL_INCREASING,
+    ),
+    ("parse_failures", "解析失败帧数", None, SensorStateClass.TOTAL_INCREASING),
+    (
+        "resync_skips",
+        "重新同步跳过字节数",
+        UnitOfInformation.BYTES,
+        SensorStateClass.TOTAL_INCREASING,
+    ),
+    ("unknown_frames", "未知地址帧数", None, SensorStateClass.TOTAL_INCREASING),
+    ("reconnects", "重连次数", None, SensorStateClass.TOTAL_INCREASING),
+    ("send_timeouts", "指令超时次数", None, SensorStateClass.TOTAL_INCREASING),
+    ("queue_depth", "发送队列长度", None, SensorStateClass.MEASUREMENT),
+    (
+        "scene_frames_skipped",
+        "场景跳过的指令数",
+        None,
+        SensorStateClass.TOTAL_INCREASING,
+    ),
+    ("panel_presses", "面板按键次数", None, SensorStateClass.TOTAL_INCREASING),
+    (
+        "press_latency_p99",
+        "按键到事件延迟 P99",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+    ),
+    (
+        "rtt_p50",
+        "指令往返时间 P50",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+    ),
+    (
+        "rtt_p99",
+        "指令往返时间 P99",
+        UnitOfTime.MILLISECONDS,
+        SensorStateClass.MEASUREMENT,
+    ),
+]
+
+
+async def async_setup_entry(
+    hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback
+) -> bool:
+    hub: DeoceanGateway = hass.data[DOMAIN][entry.entry_id]
+    async_add_entities([DeoceanGatewaySensor(hub, *metric) for metric in METRICS])
+    return True
+
+
+class DeoceanGatewaySensor(SensorEntity):
+    """德能森网关的运行指标"""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, hub: DeoceanGateway, key: str, name: str, unit, state_class):
+        self.hub = hub
+        self.key = key
+        self._attr_name = f"德能森网关 {name}"
+        self._attr_unique_id = f"{hub.unique_id}-{key}"
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = state_class
+
+    @property
+    def device_info(self):
+        """挂在网关设备下面"""
+        return {
+            "identifiers": {(DOMAIN, f"gateway_{self.hub.unique_id}")},
+            "name": f"德能森网关 ({self.hub.ip_addr})",
+            "manufacturer": "德能森",
+            "model": "智能网关",
+            "sw_version": VERSION,
+        }
+
+    @property
+    def available(self) -> bool:
+        return self.hub._listening
+
+    @property
+    def native_value(self):
+        """直接读内存中的指标, 不需要放到线程池里执行"""
+        return self.hub.metrics()[self.key]